@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+'''
+This file is part of Magpie, an automated checking framework with multiple 
+submission forms; it was originally built for automatic grading, but has many
+more potential uses than that.
+
+Copyright 2013 Joseph Lewis <joehms22@gmail.com> | <joseph@josephlewis.net>
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following disclaimer
+  in the documentation and/or other materials provided with the
+  distribution.
+* Neither the name of the  nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import threading
+import zipfile
+
+
+class UnknownArtifact(KeyError):
+	'''Raised when an artifact is asked for that nothing produces.'''
+	pass
+
+
+_producers = {} # artifact name -> (producer, artifact type)
+_producers_lock = threading.Lock()
+
+
+def register(name, producer, artifact_type=object):
+	'''Registers producer(document) as the function that computes the named
+	artifact of a document, its result must be an instance of 
+	artifact_type. Registering the same name again replaces the producer.
+	
+	Artifacts should be treated as read only by everything that uses them,
+	they're shared between plugins running at the same time.
+	'''
+	with _producers_lock:
+		_producers[name] = (producer, artifact_type)
+
+
+def get_producer(name):
+	'''Returns (producer, artifact type) for the named artifact, raises
+	UnknownArtifact if there isn't one.'''
+	with _producers_lock:
+		try:
+			return _producers[name]
+		except KeyError:
+			raise UnknownArtifact(name)
+
+
+def produce(name, document):
+	'''Computes the named artifact for the document, checking its type.'''
+	producer, artifact_type = get_producer(name)
+	artifact = producer(document)
+	if not isinstance(artifact, artifact_type):
+		raise TypeError("Artifact {} should be a {} but {} was produced".format(name, artifact_type.__name__, type(artifact).__name__))
+	return artifact
+
+
+def zip_listing(document):
+	'''Returns a dict of path -> list of names in the archive for every 
+	file in the document that is a zip archive.'''
+	listing = {}
+	for path in document.items():
+		if zipfile.is_zipfile(path):
+			with zipfile.ZipFile(path) as archive:
+				listing[path] = archive.namelist()
+	return listing
+
+
+def file_hashes(document):
+	'''Returns a dict of path -> SHA-256 of the file's contents.'''
+	return dict(document.file_hashes)
+
+
+register("zip_listing", zip_listing, dict)
+register("file_hashes", file_hashes, dict)
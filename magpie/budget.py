@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+'''
+This file is part of Magpie, an automated checking framework with multiple 
+submission forms; it was originally built for automatic grading, but has many
+more potential uses than that.
+
+Copyright 2013 Joseph Lewis <joehms22@gmail.com> | <joseph@josephlewis.net>
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following disclaimer
+  in the documentation and/or other materials provided with the
+  distribution.
+* Neither the name of the  nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import inspect
+import time
+
+_accepts = {} # function -> True if it takes a budget argument
+
+
+class Budget(object):
+	''' The time a plugin has to grade a document or batch, passed to 
+	process_upload and process_batch as the budget keyword argument by 
+	plugins that accept one.
+	
+	Plugins should check expired() between checks and report the ones they
+	didn't get to with TestAnythingProtocol.skip_test rather than keep 
+	going; plugins that run past their budget are stopped once the grace 
+	period is over.
+	
+	The deadline is wall clock time so a budget can be sent to a worker 
+	process.
+	'''
+	
+	def __init__(self, seconds, deadline=None, started=True):
+		'''If started is False the clock doesn't start until start is 
+		called, e.g. once a worker picks the work up.'''
+		self.seconds = seconds
+		self.deadline = deadline
+		if deadline == None and started:
+			self.start()
+	
+	def start(self, now=None):
+		'''Starts the clock at now, or the current time, unless it already 
+		has been. Returns the deadline.'''
+		if self.deadline == None:
+			self.deadline = (now if now != None else time.time()) + self.seconds
+		return self.deadline
+	
+	def remaining(self):
+		'''Returns the seconds left, 0 once the budget has run out.'''
+		if self.deadline == None:
+			return self.seconds
+		return max(0, self.deadline - time.time())
+	
+	def expired(self):
+		'''Returns True once the budget has run out.'''
+		return self.deadline != None and time.time() >= self.deadline
+	
+	def split(self, parts):
+		'''Returns a budget for one of parts pieces of work sharing what's 
+		left of this one.'''
+		return Budget(self.remaining() / max(1, parts))
+
+
+def accepts_budget(function):
+	'''Returns True if function takes a budget keyword argument.'''
+	key = getattr(function, '__func__', function)
+	if key not in _accepts:
+		try:
+			if hasattr(inspect, 'signature'):
+				parameters = inspect.signature(function).parameters
+				accepts = 'budget' in parameters or any(p.kind == p.VAR_KEYWORD for p in parameters.values())
+			else: # Python 2
+				spec = inspect.getargspec(function)
+				accepts = 'budget' in spec.args or spec.keywords != None
+		except (TypeError, ValueError):
+			accepts = False
+		_accepts[key] = accepts
+	return _accepts[key]
+
+
+def call(function, args, budget):
+	'''Calls function(*args), passing budget along if it accepts one. The
+	budget is started if it hasn't been yet.'''
+	if budget != None:
+		budget.start()
+	if budget != None and accepts_budget(function):
+		return function(*args, budget=budget)
+	return function(*args)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+'''
+This file is part of Magpie, an automated checking framework with multiple 
+submission forms; it was originally built for automatic grading, but has many
+more potential uses than that.
+
+Copyright 2013 Joseph Lewis <joehms22@gmail.com> | <joseph@josephlewis.net>
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following disclaimer
+  in the documentation and/or other materials provided with the
+  distribution.
+* Neither the name of the  nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import collections
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+
+def hash_configuration(configuration):
+	'''Returns a hash of a JSON compatible test configuration.'''
+	encoded = json.dumps(configuration, sort_keys=True, separators=(',', ':'))
+	return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+def make_key(content_hash, configuration_hash, plugin_name_version):
+	'''Returns the cache key for a plugin's results on some content with the
+	given configuration.'''
+	key = u"|".join([content_hash, configuration_hash, plugin_name_version])
+	return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+	''' Remembers the results plugins gave for documents so identical 
+	resubmissions don't need to be graded again.
+	
+	Recently used results are kept in memory, up to max_entries of them,
+	everything is also pickled to directory (if it isn't None) so results 
+	survive a restart. Entries older than ttl seconds are ignored in both,
+	sweep removes them from the directory along with the oldest files past
+	max_files.
+	'''
+	
+	def __init__(self, max_entries, ttl, directory=None, max_files=None):
+		self._max_entries = max_entries
+		self._ttl = ttl
+		self._directory = directory
+		self._max_files = max_files
+		self._entries = collections.OrderedDict() # key -> (stored time, pickle)
+		self._lock = threading.Lock()
+	
+	def _path(self, key):
+		return os.path.join(self._directory, key[:2], key + ".pickle")
+	
+	def get(self, key):
+		'''Returns the results stored under key, or None if there aren't any.
+		
+		A new copy of the results is returned each time, so they can be 
+		modified freely.
+		'''
+		now = time.time()
+		with self._lock:
+			entry = self._entries.pop(key, None)
+			if entry != None and now - entry[0] < self._ttl:
+				self._entries[key] = entry # move to the most recent end
+				return pickle.loads(entry[1])
+		
+		if self._directory == None:
+			return None
+		
+		try:
+			path = self._path(key)
+			stored = os.path.getmtime(path)
+			if now - stored >= self._ttl:
+				os.remove(path)
+				return None
+			
+			with open(path, 'rb') as cached:
+				data = cached.read()
+		except (IOError, OSError):
+			return None
+		
+		try:
+			results = pickle.loads(data)
+		except Exception: # truncated, corrupt or from code that's changed
+			self._remove(path)
+			return None
+		
+		self._remember(key, stored, data)
+		return results
+	
+	def put(self, key, results):
+		'''Stores the results under key.'''
+		data = pickle.dumps(results, pickle.HIGHEST_PROTOCOL)
+		self._remember(key, time.time(), data)
+		
+		if self._directory == None:
+			return
+		
+		path = self._path(key)
+		try:
+			try:
+				fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+			except OSError:
+				try:
+					os.makedirs(os.path.dirname(path))
+				except OSError:
+					pass # another thread made it first
+				fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+			
+			try:
+				with os.fdopen(fd, 'wb') as tmp:
+					tmp.write(data)
+				os.rename(tmp_path, path)
+			except (IOError, OSError):
+				self._remove(tmp_path)
+				raise
+		except (IOError, OSError):
+			pass # the memory copy is still good
+	
+	def sweep(self):
+		'''Removes files older than the ttl from the directory, then the 
+		least recently stored ones until at most max_files are left.'''
+		if self._directory == None or not os.path.isdir(self._directory):
+			return
+		
+		now = time.time()
+		files = []
+		for prefix in os.listdir(self._directory):
+			folder = os.path.join(self._directory, prefix)
+			try:
+				names = os.listdir(folder)
+			except OSError:
+				continue # not a directory, or swept by someone else
+			
+			for name in names:
+				path = os.path.join(folder, name)
+				try:
+					stored = os.path.getmtime(path)
+				except OSError:
+					continue
+				
+				if now - stored >= self._ttl:
+					self._remove(path)
+				else:
+					files.append((stored, path))
+		
+		if self._max_files != None and len(files) > self._max_files:
+			files.sort()
+			for stored, path in files[:len(files) - self._max_files]:
+				self._remove(path)
+	
+	def _remove(self, path):
+		try:
+			os.remove(path)
+		except OSError:
+			pass
+	
+	def _remember(self, key, stored, data):
+		with self._lock:
+			self._entries.pop(key, None)
+			self._entries[key] = (stored, data)
+			
+			while len(self._entries) > self._max_entries:
+				self._entries.popitem(last=False)
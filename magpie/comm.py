@@ -37,6 +37,29 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 import tap
 import uuid
 import os
+import hashlib
+import threading
+
+import magpie.storage
+import magpie.artifacts
+import magpie.serializers
+
+UPLOAD_DIRECTORY = "uploads"
+
+_default_store = None
+
+def get_default_store():
+	'''Returns the <magpie.storage.BlobStore> documents keep their files in
+	unless they're given another one.'''
+	global _default_store
+	if _default_store == None:
+		_default_store = magpie.storage.BlobStore(UPLOAD_DIRECTORY)
+	return _default_store
+
+def set_default_store(store):
+	'''Sets the <magpie.storage.BlobStore> new documents keep their files in.'''
+	global _default_store
+	_default_store = store
 
 class Document:
 	''' Represents a submitted document from a particular user
@@ -44,18 +67,71 @@ class Document:
 	frontend = None # the frontend that created this document
 	user = None # username
 	files = None # list of files the user submitted
+	file_hashes = None # path in files -> hash of its contents
+	mime_types = None # path in files -> MIME type given by the frontend
 	results = None # list of results <magpie.tap.TestAnythingProtocol>
 	meta = None # store junk in here you may want cross-plugin, 
-	#but don't depend on it being there!
+	#but don't depend on it being there! See get_artifact for a better way.
 	_document_id = None
+	_content_hash = None
+	_store = None
+	_artifacts = None # artifact name -> computed artifact
+	_artifact_locks = None # artifact name -> lock held while computing it
+	_artifacts_lock = None
 	
-	def __init__(self, user, frontend):
+	def __init__(self, user, frontend, store=None):
 		self.results = []
 		self.frontend = frontend
 		self.user = user
 		self.files = []
+		self.file_hashes = {}
+		self.mime_types = {}
 		self.meta = {}
 		self._document_id = str(uuid.uuid4()) # a unique id for the document
+		self._store = store if store != None else get_default_store()
+		self._reset_artifacts()
+	
+	def _reset_artifacts(self):
+		self._artifacts = {}
+		self._artifact_locks = {}
+		self._artifacts_lock = threading.Lock()
+	
+	def __getstate__(self):
+		'''Artifacts and their locks aren't sent to worker processes, they 
+		are computed again there if needed.'''
+		state = dict(self.__dict__)
+		for key in ('_artifacts', '_artifact_locks', '_artifacts_lock'):
+			state.pop(key, None)
+		return state
+	
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._reset_artifacts()
+	
+	def get_artifact(self, name):
+		''' Returns the named artifact of this document, e.g. a parsed 
+		project file, computing it with the producer registered in 
+		magpie.artifacts the first time it's asked for.
+		
+		Each artifact is computed at most once even when plugins ask for it
+		at the same time, they all get the same object and must not change
+		it. Raises <magpie.artifacts.UnknownArtifact> if nothing produces it.
+		'''
+		with self._artifacts_lock:
+			if name in self._artifacts:
+				return self._artifacts[name]
+			lock = self._artifact_locks.setdefault(name, threading.Lock())
+		
+		with lock:
+			with self._artifacts_lock:
+				if name in self._artifacts:
+					return self._artifacts[name]
+			
+			artifact = magpie.artifacts.produce(name, self)
+			
+			with self._artifacts_lock:
+				self._artifacts[name] = artifact
+			return artifact
 	
 	def add_results(self, results):
 		'''Adds results to the internal list of results.
@@ -76,22 +152,102 @@ class Document:
 		
 		'''
 		
-		return "<br>".join([x.to_html() for x in self.results])
+		return u"".join(self.iter_html())
+	
+	def serialize(self, format_name, out=None, encoding=None):
+		'''Writes the document's results in one of the formats registered
+		in <magpie.serializers>, e.g. "junit", to out, or returns an 
+		iterator of the pieces if out is None. See 
+		magpie.serializers.serialize.'''
+		return magpie.serializers.serialize(format_name, magpie.serializers.from_documents([self]), out, encoding)
+	
+	def iter_html(self):
+		'''Yields the HTML report a piece at a time, so large results can
+		be sent while they're being rendered.'''
+		for i, result in enumerate(self.results):
+			if i > 0:
+				yield u"<br>"
+			
+			if hasattr(result, "iter_html"):
+				for html in result.iter_html():
+					yield html
+			else:
+				yield result.to_html()
+	
+	def add_file(self, name, data, mime_type=None):
+		''' Adds a file to the document, data is either bytes, a file like
+		object or an iterable of bytes. mime_type is the type the file was
+		sent as, if the frontend knows it.
+		
+		Files are kept in the document's store, so identical files uploaded
+		with many documents are only stored once. Raises 
+		<magpie.storage.UploadTooLarge> if the file is over the store's limit,
+		or <magpie.storage.BadFilename> if name can't be used.
+		'''
+		file_path, digest = self._store.store(self._document_id, name, data)
+		
+		if file_path not in self.file_hashes:
+			self.files.append(file_path)
+		self.file_hashes[file_path] = digest
+		if mime_type != None:
+			self.mime_types[file_path] = mime_type
+		self._content_hash = None
+		self._reset_artifacts()
+	
+	def discard(self):
+		'''Removes the document's files from the store.'''
+		self._store.release(self._document_id, list(self.file_hashes.values()))
+		self.files = []
+		self.file_hashes = {}
+		self.mime_types = {}
+		self._content_hash = None
+		self._reset_artifacts()
 	
-	def add_file(self, name, data):
-		''' Adds a file to the document.
+	def to_record(self):
+		'''Returns a JSON compatible description of the document, enough to
+		rebuild it with from_record while its files are still stored.'''
+		return {
+			"id":self._document_id,
+			"user":self.user,
+			"frontend":self.frontend,
+			"files":[[path, self.file_hashes[path], self.mime_types.get(path, None)] for path in self.files]
+		}
+	
+	@staticmethod
+	def from_record(record, store=None):
+		'''Rebuilds a document saved with to_record, returns None if any of
+		its files are gone.'''
+		document = Document(record["user"], record["frontend"], store)
+		document._document_id = record["id"]
+		
+		for path, digest, mime_type in record["files"]:
+			if not os.path.exists(path):
+				return None
+			document.files.append(path)
+			document.file_hashes[path] = digest
+			if mime_type != None:
+				document.mime_types[path] = mime_type
+		
+		return document
+	
+	def content_hash(self):
+		'''Returns a hash of the names and contents of the files in this
+		document; documents with the same files have the same hash.
 		'''
-		parent_path = os.path.join('uploads', self._document_id)
-		os.makedirs(parent_path)
-		file_path = os.path.join(parent_path, name)
+		if self._content_hash != None:
+			return self._content_hash
 		
-		with open(file_path, 'wb') as fout:
-			try:
-				fout.write(data.read())
-			except AttributeError:
-				fout.write(data)
-
-		self.files.append(file_path)
+		digest = hashlib.sha256()
+		for path in self.files:
+			name = os.path.basename(path)
+			if not isinstance(name, bytes):
+				name = name.encode('utf-8')
+			
+			digest.update(name)
+			digest.update(self.file_hashes[path].encode('ascii'))
+		
+		self._content_hash = digest.hexdigest()
+		return self._content_hash
 	
 	def items(self):
 		'''Returns a list of file paths to copies of the uploaded files
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+'''
+This file is part of Magpie, an automated checking framework with multiple 
+submission forms; it was originally built for automatic grading, but has many
+more potential uses than that.
+
+Copyright 2013 Joseph Lewis <joehms22@gmail.com> | <joseph@josephlewis.net>
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following disclaimer
+  in the documentation and/or other materials provided with the
+  distribution.
+* Neither the name of the  nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import json
+import os
+import tempfile
+import threading
+import struct
+import select
+import time
+import ctypes
+import ctypes.util
+
+try:
+	from urllib import quote, unquote
+except ImportError: # Python 3
+	from urllib.parse import quote, unquote
+
+RECORD_EXTENSION = ".json"
+TMP_PREFIX = ".tmp-"
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+INOTIFY_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT = struct.Struct("iIII") # wd, mask, cookie, name length
+INOTIFY_SETTLE_S = 0.2 # wait this long for more events before reporting
+INOTIFY_STOP_CHECK_S = 1 # how often the watcher thread checks if it should stop
+
+_replace = getattr(os, 'replace', os.rename) # os.replace is Python 3 only
+
+
+def atomic_write(path, data):
+	'''Writes the bytes to path so that readers, and the file after a crash,
+	see either the old contents or the new ones, never a mix.
+	
+	The data goes to a temporary file in the same directory which is synced 
+	to disk then renamed over path.
+	'''
+	directory = os.path.dirname(os.path.abspath(path))
+	fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=TMP_PREFIX)
+	
+	try:
+		with os.fdopen(fd, 'wb') as tmp:
+			tmp.write(data)
+			tmp.flush()
+			os.fsync(tmp.fileno())
+		_replace(tmp_path, path)
+	except:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		raise
+	
+	# make sure the rename itself is on disk
+	try:
+		dir_fd = os.open(directory, os.O_RDONLY)
+		try:
+			os.fsync(dir_fd)
+		finally:
+			os.close(dir_fd)
+	except (OSError, AttributeError):
+		pass # not possible on all platforms
+
+
+def atomic_write_json(path, value):
+	'''Writes value to path as human readable JSON using atomic_write.'''
+	encoded = json.dumps(value, sort_keys=True, indent=4, separators=(',', ': '))
+	if not isinstance(encoded, bytes):
+		encoded = encoded.encode('utf-8')
+	atomic_write(path, encoded)
+
+
+class ConcurrentModification(Exception):
+	'''Raised when a record was changed by someone else since the version
+	the change was based on.'''
+	pass
+
+
+class TestConfigurationStore(object):
+	''' Keeps each test configuration in its own JSON file in a directory
+	so changing one test only reads and writes that test.
+	
+	Each record has a version that goes up by one on every change, changes
+	can pass the version they were based on and are refused with 
+	ConcurrentModification if the record has moved on since.
+	'''
+	
+	def __init__(self, directory):
+		self._directory = directory
+		self._versions = {} # test name -> version
+		self._lock = threading.Lock()
+		
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+	
+	def _path(self, name):
+		if not isinstance(name, bytes):
+			name = name.encode('utf-8')
+		return os.path.join(self._directory, quote(name, safe='') + RECORD_EXTENSION)
+	
+	def _read(self, path):
+		with open(path) as record:
+			return json.load(record)
+	
+	def load_all(self):
+		'''Reads every record, returns a dict of test name -> (version, 
+		configuration).'''
+		records = {}
+		
+		with self._lock:
+			self._versions = {}
+			for filename in os.listdir(self._directory):
+				if not filename.endswith(RECORD_EXTENSION):
+					continue
+				
+				try:
+					record = self._read(os.path.join(self._directory, filename))
+				except (IOError, ValueError):
+					continue # partially copied in or hand edited badly
+				
+				self._versions[record['name']] = record['version']
+				records[record['name']] = (record['version'], record['plugins'])
+		
+		return records
+	
+	def reload(self, filename):
+		'''Re-reads the record in filename after it was changed by someone
+		else.
+		
+		Returns a tuple of (name, version, configuration) if it changed, with
+		version and configuration None if it was deleted, otherwise None.
+		'''
+		if not filename.endswith(RECORD_EXTENSION):
+			return None
+		
+		name = unquote(filename[:-len(RECORD_EXTENSION)])
+		if isinstance(name, bytes):
+			name = name.decode('utf-8')
+		
+		with self._lock:
+			try:
+				record = self._read(os.path.join(self._directory, filename))
+			except IOError:
+				if self._versions.pop(name, None) == None:
+					return None
+				return (name, None, None)
+			except ValueError:
+				return None # half written by an editor, wait for the next change
+			
+			if self._versions.get(record['name'], None) == record['version']:
+				return None
+			
+			self._versions[record['name']] = record['version']
+			return (record['name'], record['version'], record['plugins'])
+	
+	def version(self, name):
+		'''Returns the current version of the test, or None if it doesn't 
+		exist.'''
+		with self._lock:
+			return self._versions.get(name, None)
+	
+	def _check_version(self, name, expected_version):
+		'''Must hold _lock.'''
+		current = self._versions.get(name, None)
+		if expected_version != None and expected_version != current:
+			raise ConcurrentModification(u"{} is at version {}, not {}".format(name, current, expected_version))
+		return current
+	
+	def _write(self, name, version, configuration):
+		'''Must hold _lock.'''
+		atomic_write_json(self._path(name), {"name":name, "version":version, "plugins":configuration})
+		self._versions[name] = version
+	
+	def save(self, name, configuration, expected_version=None):
+		'''Replaces the whole test configuration, returns its new version.'''
+		with self._lock:
+			version = (self._check_version(name, expected_version) or 0) + 1
+			self._write(name, version, configuration)
+			return version
+	
+	def update(self, name, changes, expected_version=None):
+		'''Replaces only the plugin sections in changes, a dict of plugin 
+		identifier -> configuration, a configuration of None removes that 
+		section.
+		
+		Returns a tuple of (new version, new configuration). Raises 
+		ConcurrentModification if the record's file was removed or is being
+		rewritten by someone else.
+		'''
+		with self._lock:
+			current = self._check_version(name, expected_version)
+			configuration = {}
+			if current != None:
+				try:
+					configuration = self._read(self._path(name))['plugins']
+				except (IOError, OSError):
+					self._versions.pop(name, None)
+					raise ConcurrentModification(u"{} was removed".format(name))
+				except ValueError:
+					raise ConcurrentModification(u"{} is being changed by someone else".format(name))
+			
+			for identifier, section in changes.items():
+				if section == None:
+					configuration.pop(identifier, None)
+				else:
+					configuration[identifier] = section
+			
+			version = (current or 0) + 1
+			self._write(name, version, configuration)
+			return version, configuration
+	
+	def delete(self, name, expected_version=None):
+		'''Removes the test configuration.'''
+		with self._lock:
+			self._check_version(name, expected_version)
+			try:
+				os.remove(self._path(name))
+			except OSError:
+				pass # already gone
+			self._versions.pop(name, None)
+
+
+class FileWatcher(object):
+	''' Reports changes to files in a set of directories.
+	
+	Uses inotify where it is available, start() returns False otherwise and
+	poll() needs to be called periodically instead. Either way callback is 
+	called with the path of each file that changed, temporary files made by
+	atomic_write are ignored.
+	'''
+	
+	def __init__(self, directories, callback, logger):
+		self._directories = [os.path.abspath(d) for d in directories]
+		self._callback = callback
+		self._logger = logger
+		self._snapshot = self._scan()
+		self._stopped = False
+		self._thread = None
+	
+	def _scan(self):
+		'''Returns a dict of path -> (modification time, size).'''
+		snapshot = {}
+		for directory in self._directories:
+			try:
+				names = os.listdir(directory)
+			except OSError:
+				continue
+			
+			for name in names:
+				path = os.path.join(directory, name)
+				try:
+					info = os.stat(path)
+				except OSError:
+					continue
+				snapshot[path] = (info.st_mtime, info.st_size)
+		return snapshot
+	
+	def _report(self, paths):
+		for path in sorted(paths):
+			if os.path.basename(path).startswith(TMP_PREFIX):
+				continue
+			
+			try:
+				self._callback(path)
+			except Exception:
+				self._logger.exception("Handling change to {} failed".format(path))
+	
+	def poll(self):
+		'''Checks the directories for changes since the last poll.'''
+		snapshot = self._scan()
+		changed = set(p for p in snapshot if self._snapshot.get(p, None) != snapshot[p])
+		changed.update(p for p in self._snapshot if p not in snapshot)
+		self._snapshot = snapshot
+		self._report(changed)
+	
+	def start(self):
+		'''Starts watching with inotify on a background thread, returns 
+		False if inotify isn't available.'''
+		try:
+			libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+			fd = libc.inotify_init()
+		except (OSError, AttributeError):
+			return False
+		
+		if fd < 0:
+			return False
+		
+		watches = {}
+		for directory in self._directories:
+			wd = libc.inotify_add_watch(fd, directory.encode('utf-8'), INOTIFY_MASK)
+			if wd < 0:
+				os.close(fd)
+				return False
+			watches[wd] = directory
+		
+		self._thread = threading.Thread(target=self._watch, args=(fd, watches), name="Config Watcher")
+		self._thread.daemon = True
+		self._thread.start()
+		return True
+	
+	def stop(self):
+		'''Stops the inotify thread, if it was started.'''
+		self._stopped = True
+		if self._thread != None:
+			self._thread.join()
+	
+	def _watch(self, fd, watches):
+		while not self._stopped:
+			# wake up now and then to see if we've been stopped
+			if not select.select([fd], [], [], INOTIFY_STOP_CHECK_S)[0]:
+				continue
+			
+			changed = set()
+			data = os.read(fd, 64 * 1024)
+			
+			# editors and atomic_write make several events per save
+			time.sleep(INOTIFY_SETTLE_S)
+			
+			while data:
+				offset = 0
+				while offset < len(data):
+					wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+					offset += INOTIFY_EVENT.size
+					name = data[offset:offset + length].rstrip(b'\0').decode('utf-8')
+					offset += length
+					
+					if wd in watches and name:
+						changed.add(os.path.join(watches[wd], name))
+				
+				data = self._read_pending(fd)
+			
+			self._snapshot = self._scan()
+			self._report(changed)
+		
+		os.close(fd)
+	
+	def _read_pending(self, fd):
+		'''Returns any events already waiting, without blocking.'''
+		if select.select([fd], [], [], 0)[0]:
+			return os.read(fd, 64 * 1024)
+		return b''
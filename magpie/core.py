@@ -42,23 +42,75 @@ import imp
 import os
 import sys
 import inspect
+import importlib
 import traceback
+import signal
 
 from magpie.plugins.abstract_plugin import AbstractPlugin
+import magpie.tap
+import magpie.workers
+import magpie.jobs
+import magpie.cache
+import magpie.comm
+import magpie.storage
+import magpie.scheduler
+import magpie.config
+import magpie.manifest
+import magpie.routing
+import magpie.plans
+import magpie.journal
+import magpie.budget
 
-TASK_CHECK_SLEEP_S = 60
 PLUGINS_DIRECTORY = "plugins/"
+MANIFEST_LOCATION = "plugin_manifest.json"
 CONFIG_FILE_LOCATION = "config.json"
 DEFAULT_TEST_CONFIGURATION_NAME = "Default"
+DEFAULT_PLUGIN_EXECUTOR = u"process" # used when PluginExecutor is missing or unknown
 
 DEFAULT_MAGPIE_CONFIG = {
 "Title":u"Automated Submission Tool",
 "Header":u"Welcome to the automated submission tool!",
-"Footer":u"Copyright 2013 Joseph Lewis III"
+"Footer":u"Copyright 2013 Joseph Lewis III",
+"PluginExecutor":DEFAULT_PLUGIN_EXECUTOR, # one of thread, process or serial
+"PluginExecutors":{}, # plugin name -> executor, overrides PluginExecutor
+"PluginWorkers":4,
+"PluginTimeout":120, # seconds per document, plugins skip the checks left after
+"PluginTimeoutGrace":10, # seconds past PluginTimeout before a plugin is stopped
+"PluginBatchSize":25, # most documents handed to a plugin at once
+"WorkerMaxJobs":200, # process workers are replaced after this many jobs
+"WorkerMaxMemoryMB":1024, # or after using this much memory
+"UploadDirectory":u"uploads",
+"MaxUploadBytes":50 * 1024 * 1024, # 0 for no limit
+"ResultCacheEnabled":True,
+"ResultCacheEntries":1024, # results kept in memory
+"ResultCacheTTL":7 * 24 * 60 * 60, # seconds
+"ResultCacheDirectory":u"cache", # results are kept on disk here, or null
+"ResultCacheFiles":65536, # most results kept on disk, or null for no limit
+"TaskWorkers":4, # threads running scheduled tasks
+"StartupBudgetSeconds":2, # warn if loading plugins takes longer
+"TestConfigurationDirectory":u"test_configurations", # one file per test
+"WatchConfiguration":True, # reload config files when they're edited
+"ConfigPollInterval":5, # seconds between checks when inotify isn't available
+"ConfigWriteDelay":5, # seconds without changes before config.json is written
+"ConfigWriteMaxDelay":60, # longest a change waits to be written
+"GradingWorkers":4,
+"PostProcessWorkers":2, # threads running plugins' upload_processed
+"PostProcessQueue":1000, # graded documents waiting for them, 0 for no limit
+"JobHistory":1000, # finished jobs to remember for frontends
+"ShutdownTimeout":30, # seconds to finish queued jobs, the rest resume on restart
+"Journal":u"journal.jsonl", # jobs in progress are recorded here, or null
+"JournalSync":True, # fsync every journal entry
+"JournalCompactEntries":10000 # rewrite the journal once it has this many entries
 }
 
+PLUGIN_EXECUTORS = ("thread", "process", "serial")
+
 DEFAULT_CONFIGURATION_CONFIG = {}
 
+CONFIG_FLUSH_CHECK_S = 1 # how often to check if the config needs writing
+JOURNAL_COMPACT_CHECK_S = 60 # how often to check if the journal needs compacting
+CACHE_SWEEP_S = 60 * 60 # how often old results are removed from the disk cache
+
 
 def log_results(fn):
 	''' A decorator to log the calls to a function.'''
@@ -69,93 +121,116 @@ def log_results(fn):
 		return ret
 	return new
 
-class Magpie:
+def _timed_out(result):
+	'''Returns True if a plugin's result, a TestAnythingProtocol or a list
+	of them, has checks that were skipped because it ran out of time.'''
+	results = result if isinstance(result, (list, tuple)) else [result]
+	return any(isinstance(r, magpie.tap.TestAnythingProtocol) and r.timed_out() for r in results)
+
+class Magpie(object):
 	_logger = None
 	_loaded_plugins = None
 	_loaded_plugins_lock = threading.Lock()
-	_tasks = None # [function to call, n minutes, last_running_thread]
+	_dispatch = None # <magpie.routing.DispatchIndex> of the loaded plugins
+	_scheduler = None # <magpie.scheduler.Scheduler> running periodic tasks
+	_thread_pool = None # runs process_upload for thread executor plugins
+	_process_pool = None # runs process_upload for process executor plugins
+	_jobs = None # <magpie.jobs.JobQueue> of submitted documents
+	_post_pool = None # runs upload_processed once documents are graded
+	_shutting_down = False
+	_watcher = None # <magpie.config.FileWatcher> of the configuration files
+	_journal = None # <magpie.journal.Journal> of jobs, or None if disabled
+	_result_cache = None # <magpie.cache.ResultCache> or None if disabled
+	_config_lock = None
+	_test_store = None # <magpie.config.TestConfigurationStore>
+	_tests_lock = None # held while changing test configurations
+	_snapshot = None # <magpie.plans.ConfigurationSnapshot> of the tests
+	_config_version = 0 # incremented on every configuration change
+	_written_config_version = 0 # the version last written to disk
+	_config_first_change = None # time of the oldest unwritten change
+	_config_last_change = None # time of the newest unwritten change
 	
 	# various configurations
-	test_configurations = None
 	magpie_configuration = None
 	plugin_configuration = None
 
 	def __init__(self):
 		''' Sets up the core of the program.
 		'''
-		self._tasks = {}
 		self._logger = self.get_logger("Magpie Core")
+		self._config_lock = threading.Lock()
+		self._tests_lock = threading.Lock()
 		
 		self._logger.info("Starting Program")
 		
 		self.__load_configuration()
+		self.__setup_storage()
+		self._scheduler = magpie.scheduler.Scheduler(self.global_config("TaskWorkers", 4), self.get_logger("Scheduler"))
 		self.__load_plugins()
+		self.__setup_executors()
+		self.__compile_test_plans()
 		
 		self.upgrade_test_configurations()
 		
 		if len(self.test_configurations) == 0:
 			self.make_new_test_configuration(DEFAULT_TEST_CONFIGURATION_NAME)
+		
+		self.__resume_jobs()
 
 		self._logger.info("Finished Init")
 		
-		# write the config file every few minutes
-		self.call_function(self.write_config, 1)
+		# write the config file shortly after it changes
+		self.schedule(self.flush_config, CONFIG_FLUSH_CHECK_S)
+		if self._journal != None:
+			self.schedule(self.compact_journal, JOURNAL_COMPACT_CHECK_S)
+		if self._result_cache != None:
+			self.schedule(self._result_cache.sweep, CACHE_SWEEP_S)
+		self.__watch_configuration()
 		
+		try:
+			signal.signal(signal.SIGTERM, self._terminate)
+		except ValueError:
+			pass # signals can only be handled in the main thread
 		
-		running_tasks = {}
 		try:
-			while True:
-				self._logger.info("Waking up to do CRON tasks")
-				tm = int(time.time() / 60) # get current minute
-				for function, minutes in self._tasks.items():
-					if tm % minutes != 0:
-						continue
-					
-					last = running_tasks.get(function, None)
-					
-					if last != None and last.is_alive(): # don't re-spawn proceses that are already running
-						continue
-					
-					try:
-						last = threading.Thread(target=function)
-						last.daemon = True
-						last.start()
-						
-						running_tasks[function] = last
-					except Exception as e:
-						self._logger.error(str(e))
-					
-				time.sleep(TASK_CHECK_SLEEP_S)
+			self._scheduler.run()
 		except(KeyboardInterrupt,SystemExit):
 			self.shutdown()
 		
 	@log_results
 	def __load_configuration(self):
 		'''Loads the main configuration file for the project, on JSON
-		error, returns a blank config.'''
+		error, returns a blank config.
+		
+		Test configurations are loaded from their own store, tests found in
+		config.json by older versions are moved there.'''
 		cfg = {}
 		try:
 			with open(CONFIG_FILE_LOCATION) as config:
 				cfg = json.load(config)
 
 		except IOError:
-			pass
+			self.mark_config_dirty() # write out the defaults
 		except ValueError: # on JSON parse error
 			print("Error")
-			if self.test_configuration == None:
-				self.test_configuration = {}
-			if self.magpie_configuration == None:
-				self.magpie_configuration = DEFAULT_MAGPIE_CONFIG
-			if self.plugin_configuration == None:
-				self.plugin_configuration = {}
-			return
-			
 		
-		self.test_configurations = cfg.get('tests', {})
 		self.magpie_configuration = cfg.get('magpie', DEFAULT_MAGPIE_CONFIG)
 		AbstractPlugin._supplement_dict(self.magpie_configuration, DEFAULT_MAGPIE_CONFIG)
 		self.plugin_configuration = cfg.get('plugins', {})
 		
+		self._test_store = magpie.config.TestConfigurationStore(
+			self.global_config("TestConfigurationDirectory", "test_configurations"))
+		records = self._test_store.load_all()
+		
+		for name, config in cfg.get('tests', {}).items():
+			if name not in records:
+				records[name] = (self._test_store.save(name, config), config)
+		
+		if 'tests' in cfg:
+			self.mark_config_dirty() # drop the tests from config.json
+		
+		self._snapshot = magpie.plans.ConfigurationSnapshot.build(records, [])
+		
 		self.update_plugin_configurations()
 	
 	@log_results
@@ -173,29 +248,236 @@ class Magpie:
 			print(config)
 			if config:
 				plug.update_config(config)
+		
+		self.mark_config_dirty()
 
+	def __watch_configuration(self):
+		'''Starts watching config.json and the test configurations so 
+		changes made by hand are applied without a restart.'''
+		if not self.global_config("WatchConfiguration", True):
+			return
+		
+		directories = [os.path.dirname(os.path.abspath(CONFIG_FILE_LOCATION)),
+			self.global_config("TestConfigurationDirectory", "test_configurations")]
+		self._watcher = magpie.config.FileWatcher(directories, self._configuration_file_changed, self._logger)
+		
+		if not self._watcher.start():
+			self._logger.info("inotify isn't available, polling for configuration changes")
+			self.schedule(self._watcher.poll, self.global_config("ConfigPollInterval", 5))
+	
+	def _configuration_file_changed(self, path):
+		'''Called by the watcher when a file that may be configuration 
+		changes.'''
+		tests_directory = os.path.abspath(self.global_config("TestConfigurationDirectory", "test_configurations"))
+		
+		if path == os.path.abspath(CONFIG_FILE_LOCATION):
+			self.reload_configuration()
+		elif os.path.dirname(path) == tests_directory:
+			with self._tests_lock:
+				change = self._test_store.reload(os.path.basename(path))
+				if change == None:
+					return
+				
+				name, version, config = change
+				self._logger.info(u"Test configuration {} changed on disk".format(name))
+				if config == None:
+					self._snapshot = self._snapshot.without_test(name)
+				else:
+					self._snapshot = self._snapshot.with_test(name, config, version, self.get_plugins())
+	
+	@log_results
+	def reload_configuration(self):
+		'''Re-reads config.json after it was changed outside of Magpie.
+		
+		Only plugins whose section actually changed are given the new 
+		configuration, so saving the file unchanged (or Magpie writing it)
+		does nothing. Some Magpie settings only take effect on restart.
+		'''
+		try:
+			with open(CONFIG_FILE_LOCATION) as config:
+				cfg = json.load(config)
+		except (IOError, ValueError) as e:
+			self._logger.warning("Not reloading {}: {}".format(CONFIG_FILE_LOCATION, e))
+			return
+		
+		magpie_config = cfg.get('magpie', {})
+		AbstractPlugin._supplement_dict(magpie_config, DEFAULT_MAGPIE_CONFIG)
+		if magpie_config != self.magpie_configuration:
+			self._logger.info("Magpie configuration changed")
+			self.magpie_configuration = magpie_config
+		
+		loaded = set(plug.get_name() for plug in self.get_plugins())
+		for name, config in cfg.get('plugins', {}).items():
+			if name in loaded:
+				continue
+			
+			if not self._plugin_enabled(name) and (config or {}).get('enabled', True) != False:
+				self._logger.warning("{} was enabled, restart Magpie to load it".format(name))
+			self.plugin_configuration[name] = config
+		
+		for plug in self.get_plugins():
+			config = cfg.get('plugins', {}).get(plug.get_name(), None)
+			if config == None or config == plug.get_config():
+				continue
+			
+			self._logger.info("Configuration for {} changed".format(plug.get_name()))
+			self.plugin_configuration[plug.get_name()] = config
+			plug.update_config(config)
+	
+	def __setup_storage(self):
+		'''Sets up the store uploaded files are kept in.'''
+		store = magpie.storage.BlobStore(self.global_config("UploadDirectory", "uploads"),
+			self.global_config("MaxUploadBytes", 50 * 1024 * 1024))
+		magpie.comm.set_default_store(store)
+	
+	def __setup_executors(self):
+		'''Creates the pools used to run plugins on submitted documents and
+		the queue of documents waiting to be graded.
+		
+		The process pool is only started if some plugin is configured to 
+		use it, and must be started after the plugins are loaded so the 
+		processes can import them.
+		'''
+		workers = self.global_config("PluginWorkers", 4)
+		
+		if self.global_config("PluginExecutor", DEFAULT_PLUGIN_EXECUTOR) == "serial":
+			self._thread_pool = magpie.workers.SerialPool()
+		else:
+			self._thread_pool = magpie.workers.ThreadPool(workers, "Plugin Worker")
+		
+		executors = [self.global_config("PluginExecutor", DEFAULT_PLUGIN_EXECUTOR)]
+		executors += self.global_config("PluginExecutors", {}).values()
+		executors = [executor if executor in PLUGIN_EXECUTORS else DEFAULT_PLUGIN_EXECUTOR for executor in executors]
+		
+		if "process" in executors:
+			self._process_pool = magpie.workers.ProcessPool(workers, 
+				self.get_plugins,
+				self.global_config("WorkerMaxJobs", 200),
+				self.global_config("WorkerMaxMemoryMB", 1024),
+				self.get_logger("Process Pool"))
+		
+		if self.global_config("ResultCacheEnabled", True):
+			self._result_cache = magpie.cache.ResultCache(
+				self.global_config("ResultCacheEntries", 1024),
+				self.global_config("ResultCacheTTL", 7 * 24 * 60 * 60),
+				self.global_config("ResultCacheDirectory", "cache"),
+				self.global_config("ResultCacheFiles", 65536))
+		
+		self._post_pool = magpie.workers.ThreadPool(
+			self.global_config("PostProcessWorkers", 2),
+			"Post Processing Worker",
+			self.global_config("PostProcessQueue", 1000))
+		
+		journal_location = self.global_config("Journal", "journal.jsonl")
+		if journal_location != None:
+			self._journal = magpie.journal.Journal(journal_location, 
+				self.global_config("JournalSync", True))
+		
+		self._jobs = magpie.jobs.JobQueue(self.grade_documents, 
+			self.global_config("GradingWorkers", 4),
+			self.global_config("JobHistory", 1000),
+			self._logger,
+			self._journal,
+			self.post_process)
+	
+	def get_plugins(self):
+		'''Returns a list of the loaded plugins.'''
+		with self._loaded_plugins_lock:
+			return list(self._loaded_plugins)
+	
+	def _executor_for(self, plugin):
+		'''Returns the name of the executor the given plugin should run in.'''
+		executor = self.global_config("PluginExecutors", {}).get(plugin.get_name(), None)
+		
+		if executor == None:
+			executor = self.global_config("PluginExecutor", DEFAULT_PLUGIN_EXECUTOR)
+		
+		if executor not in PLUGIN_EXECUTORS:
+			self._logger.warning("Unknown executor {} for {}, using {}".format(executor, plugin.get_name(), DEFAULT_PLUGIN_EXECUTOR))
+			executor = DEFAULT_PLUGIN_EXECUTOR
+		
+		return executor
+	
 	def __load_plugins(self):
 		'''Loads the plugins from the plugin directory and sets up core with 
 		them.
 		
+		Modules are only imported if the plugin manifest doesn't know what's
+		in them yet or one of their plugins is needed now; lazy plugins are 
+		imported on their first document and disabled ones not at all.
 		'''
 		self._logger.info("Setting Up Plugins")
+		start = time.time()
 		
 		self._loaded_plugins = []
-		load_plugins(PLUGINS_DIRECTORY, AbstractPlugin)
-		plugins = AbstractPlugin.__subclasses__()
-		
-		for plugin in plugins:
-			self._logger.info("Loading plugin: {}".format(plugin))
-			plugin = plugin()
-			pconfig = self.plugin_configuration.get(plugin.get_name(), {})
-			if pconfig == None:
-				pconfig = {}
-			plugin.setup(pconfig, self.get_logger(plugin.get_name()), self)
+		plugin_dir = os.path.realpath(PLUGINS_DIRECTORY)
+		if plugin_dir not in sys.path:
+			sys.path.append(plugin_dir)
+		
+		manifest = magpie.manifest.PluginManifest(MANIFEST_LOCATION)
+		modules = magpie.manifest.module_names(plugin_dir)
+		manifest.retain([name for name, path in modules])
+		
+		for name, path in modules:
+			mtime = magpie.manifest.module_mtime(path)
+			entries = manifest.lookup(name, path, mtime)
+			
+			if entries == None: # new or changed, import it to find out
+				try:
+					module = importlib.import_module(name)
+					plugins = [cls() for cls in magpie.manifest.plugin_classes(module)]
+				except Exception as e:
+					self._logger.error("Problem importing {}: {}".format(name, e))
+					continue
+				
+				manifest.record(name, path, mtime, [magpie.manifest.describe(p) for p in plugins])
+				for plugin in plugins:
+					if self._plugin_enabled(plugin.get_name()):
+						self.__add_plugin(plugin)
+				continue
 			
-			with self._loaded_plugins_lock:
-				self._loaded_plugins.append(plugin)
+			for entry in entries:
+				if not self._plugin_enabled(entry["name"]):
+					self._logger.info("Skipping disabled plugin: {}".format(entry["name"]))
+					continue
+				
+				try:
+					if entry["capabilities"].get("lazy", False):
+						plugin = magpie.manifest.LazyPlugin(name, entry, self._logger, self)
+					else:
+						plugin = getattr(importlib.import_module(name), entry["class"])()
+				except Exception as e:
+					self._logger.error("Problem importing {}: {}".format(name, e))
+					continue
+				
+				self.__add_plugin(plugin)
+		
+		manifest.save()
+		self._dispatch = magpie.routing.DispatchIndex(self._loaded_plugins)
 		
+		elapsed = time.time() - start
+		budget = self.global_config("StartupBudgetSeconds", 2)
+		if elapsed > budget:
+			self._logger.warning("Loading plugins took {:.2f}s, over the budget of {}s".format(elapsed, budget))
+		else:
+			self._logger.info("Loading plugins took {:.2f}s".format(elapsed))
+	
+	def __add_plugin(self, plugin):
+		'''Sets up the plugin and adds it to the loaded plugins.'''
+		self._logger.info("Loading plugin: {}".format(plugin.get_name()))
+		pconfig = self.plugin_configuration.get(plugin.get_name(), {})
+		if pconfig == None:
+			pconfig = {}
+		plugin.setup(pconfig, self.get_logger(plugin.get_name()), self)
+		
+		with self._loaded_plugins_lock:
+			self._loaded_plugins.append(plugin)
+	
+	def _plugin_enabled(self, name):
+		'''Returns False if the plugin's configuration has enabled set to 
+		false.'''
+		config = self.plugin_configuration.get(name, None) or {}
+		return config.get('enabled', True) != False
 	
 	def global_config(self, key, default_value):
 		''' Returns a portion of the global config.'''
@@ -225,10 +507,73 @@ class Magpie:
 		for p in self._loaded_plugins:
 			cfg[p.get_name()] = p.get_default_test_configuration()
 		
-		self.test_configurations[name] = cfg
+		self.save_test_configuration(name, cfg)
 		
 		return cfg
 	
+	def get_test_configuration_version(self, name):
+		'''Returns the current version of the named test configuration, or 
+		None if it doesn't exist.'''
+		return self._snapshot.versions.get(name, None)
+	
+	def save_test_configuration(self, name, config, expected_version=None):
+		'''Saves the whole test configuration, returns its new version.
+		
+		If expected_version isn't None and the test has been changed since
+		that version <magpie.config.ConcurrentModification> is raised.
+		'''
+		with self._tests_lock:
+			version = self._test_store.save(name, config, expected_version)
+			self._snapshot = self._snapshot.with_test(name, config, version, self.get_plugins())
+		return version
+	
+	def update_test_configuration(self, name, changes, expected_version=None):
+		'''Changes only the plugin sections of the test configuration given
+		in changes, a dict of plugin identifier -> configuration, None 
+		removes a section. Returns the new version.
+		
+		If expected_version isn't None and the test has been changed since
+		that version <magpie.config.ConcurrentModification> is raised.
+		'''
+		with self._tests_lock:
+			version, config = self._test_store.update(name, changes, expected_version)
+			self._snapshot = self._snapshot.with_test(name, config, version, self.get_plugins())
+		return version
+	
+	def delete_test_configuration(self, name, expected_version=None):
+		'''Deletes the test configuration.
+		
+		If expected_version isn't None and the test has been changed since
+		that version <magpie.config.ConcurrentModification> is raised.
+		'''
+		with self._tests_lock:
+			self._test_store.delete(name, expected_version)
+			self._snapshot = self._snapshot.without_test(name)
+	
+	def __compile_test_plans(self):
+		'''Compiles every test configuration for the loaded plugins.'''
+		with self._tests_lock:
+			snapshot = self._snapshot
+			records = dict((name, (snapshot.versions[name], config)) for name, config in snapshot.tests.items())
+			self._snapshot = magpie.plans.ConfigurationSnapshot.build(records, self.get_plugins())
+	
+	@property
+	def test_configurations(self):
+		'''A read only dict of test name -> test configuration, use the 
+		*_test_configuration methods to change them.'''
+		return self._snapshot.tests
+	
+	def get_configuration_snapshot(self):
+		'''Returns the current <magpie.plans.ConfigurationSnapshot>, it won't
+		change while it's being used.'''
+		return self._snapshot
+	
+	def get_test_plan(self, configuration_type):
+		'''Returns the <magpie.plans.TestPlan> documents submitted with the
+		given configuration type are graded with, falling back to the 
+		default test if it doesn't exist or is empty.'''
+		return self._snapshot.plan_for(configuration_type, DEFAULT_TEST_CONFIGURATION_NAME, self.get_plugins())
+	
 	def _decompose_plugin_identifier(self, identifier):
 		'''Decomposes a plugin identifier in to a name and version.
 		
@@ -242,6 +587,7 @@ class Magpie:
 	def upgrade_test_configurations(self):
 		'''Upgrades all of the test configurations in the project.'''
 		new_configurations = {}
+		upgraded = set()
 		plugins_by_name = dict((p.get_name(), p) for p in self._loaded_plugins)
 		
 		for testname, configurations in self.test_configurations.items():
@@ -249,46 +595,200 @@ class Magpie:
 			
 			for identifier, config in configurations.items():
 				name, version = self._decompose_plugin_identifier(identifier)
-				plugin = plugins_by_name[name]
+				plugin = plugins_by_name.get(name, None)
 				
-				# if version is new enough, don't upgrade
-				if version >= str(plugin.get_version()):
+				# if the plugin isn't loaded or version is new enough, don't upgrade
+				if plugin == None or version >= str(plugin.get_version()):
 					new_configurations[testname][identifier] = config
 				else:
-					AbstractPlugin._supplement_dict(config, plugin.get_default_test_configuration())
+					config = AbstractPlugin._supplement_dict(dict(config), plugin.get_default_test_configuration())
 					new_configurations[testname][plugin.get_name_version()] = config
+					upgraded.add(testname)
+		
+		for testname in upgraded:
+			self.save_test_configuration(testname, new_configurations[testname])
+	
+	def submit_document(self, document, configuration_type, callback=None):
+		''' Queues an uploaded document to be graded and returns the id of 
+		the job grading it right away.
+		
+		callback(job) is called with the <magpie.jobs.Job> once grading 
+		finishes, alternatively the job can be polled for with get_job.
+		
+		Raises <magpie.jobs.QueueClosed> once Magpie is shutting down, 
+		frontends can check is_accepting first.
+		'''
+		return self._jobs.submit(document, configuration_type, callback)
+	
+	def submit_documents(self, documents, configuration_type, callback=None):
+		''' Queues a list of documents to be graded together with the same
+		test configuration, e.g. a whole class's submissions, and returns the
+		ids of their jobs in the same order.
+		
+		Plugins are given the documents in batches of PluginBatchSize 
+		through process_batch, so they can share work between them.
+		callback(job) is called for each job as in submit_document.
 		
-		self.test_configurations = new_configurations
+		Raises <magpie.jobs.QueueClosed> once Magpie is shutting down.
+		'''
+		return self._jobs.submit_batch(list(documents), configuration_type, callback)
+	
+	def is_accepting(self):
+		'''Returns False once Magpie has started shutting down, frontends 
+		should stop taking submissions.'''
+		return self._jobs != None and not self._jobs.is_closed()
+	
+	def get_job(self, job_id):
+		'''Returns the <magpie.jobs.Job> for the given id, or None if it
+		doesn't exist or has been forgotten.'''
+		return self._jobs.get(job_id)
+	
+	def post_process(self, job):
+		''' Queues the graded job's document to have upload_processed called
+		on the plugins that graded it and on every frontend, off the grading
+		threads, so follow up work like sending replies, archiving or 
+		statistics doesn't hold up grading. The job is delivered once that's
+		done, if any plugin fails it is undelivered and only the plugins that
+		failed are told again when it's resumed.
+		
+		Blocks if PostProcessQueue documents are already waiting.
+		'''
+		self._post_pool.submit(self._run_post_processing, job)
+	
+	def _run_post_processing(self, job):
+		document = job.document
+		failed = []
+		for plug in self._dispatch.listeners(document):
+			if job.listeners != None and plug.get_name() not in job.listeners:
+				continue # told before a restart
+			
+			try:
+				plug.upload_processed(document)
+			except Exception:
+				self._logger.exception("{} failed post processing {}".format(plug.get_name(), document._document_id))
+				failed.append(plug.get_name())
+		
+		if self._journal != None:
+			if len(failed) > 0:
+				self._journal.record(job.job_id, magpie.journal.JOB_UNDELIVERED, listeners=failed)
+			else:
+				self._journal.record(job.job_id, magpie.journal.JOB_DELIVERED)
+	
+	def grade_document(self, document, configuration_type):
+		''' Processes an uploaded document, see grade_documents.'''
+		return self.grade_documents([document], configuration_type)[0]
 	
 	@log_results
-	def submit_document(self, document, configuration_type):
-		''' Processes an uploaded document.
+	def grade_documents(self, documents, configuration_type):
+		''' Processes a list of uploaded documents.
+		
+		Every plugin that can grade a document, see 
+		<magpie.routing.DispatchIndex>, is run on it at the same time using
+		the executor it is configured for, results are added to each 
+		document in the order the plugins were loaded regardless of which
+		finishes first. Documents going to the same plugin are handed to it
+		in batches of up to PluginBatchSize.
+		
+		Each batch has a <magpie.budget.Budget> of PluginTimeout seconds per
+		document, starting when a worker picks the batch up, plugins that 
+		take one skip the checks they have no time left for. A batch that 
+		still hasn't finished PluginTimeoutGrace seconds later is given up 
+		on, and its worker process killed, and each of its documents gets a
+		skipped result instead.
+		
+		Results are looked up in the result cache first, so a plugin only
+		sees the same files with the same configuration once. Results with
+		checks skipped for time aren't cached.
+		
+		Plugins are given their part of the test's compiled 
+		<magpie.plans.TestPlan> rather than the raw test configuration.
 		'''
 		
-		cfgs = self.test_configurations.get(configuration_type, {})
+		plan = self.get_test_plan(configuration_type)
+		routes = [self._dispatch.route(document) for document in documents]
+		timeout = self.global_config("PluginTimeout", 120)
+		grace = self.global_config("PluginTimeoutGrace", 10)
+		batch_size = max(1, self.global_config("PluginBatchSize", 25))
 		
-		if len(cfgs) == 0:
-			cfgs = self.test_configurations.get(DEFAULT_TEST_CONFIGURATION_NAME, {})
+		outcomes = {} # (document index, plugin) -> results
+		batches = [] # (plugin, [(document index, cache key)], pending result, budget)
 		
-		plugins = []
-		with self._loaded_plugins_lock:
-			plugins += self._loaded_plugins
+		for plug in self.get_plugins():
+			indexes = [i for i, route in enumerate(routes) if plug in route]
+			if len(indexes) == 0:
+				continue
 			
-		for plug in plugins:
+			plugin_plan = plan.for_plugin(plug)
+			try:
+				compiled = plugin_plan.compiled()
+			except Exception:
+				self._logger.exception(u"{} couldn't compile test {}".format(plug.get_name(), plan.name))
+				continue
 			
-			# get the configuration for the given type for the given plugin
-			cfg = cfgs.get(plug.get_name_version(), None)
-			if cfg == None:
-				cfg = plug.get_default_test_configuration()
-				cfgs[plug.get_name()] = cfg
+			uncached = []
+			for i in indexes:
+				cache_key = None
+				if self._result_cache != None:
+					cache_key = magpie.cache.make_key(documents[i].content_hash(),
+						plugin_plan.configuration_hash,
+						plug.get_name_version())
+					
+					cached = self._result_cache.get(cache_key)
+					if cached != None:
+						outcomes[(i, plug)] = cached
+						continue
+				
+				uncached.append((i, cache_key))
+			
+			for b in range(0, len(uncached), batch_size):
+				batch = uncached[b:b + batch_size]
+				batch_documents = [documents[i] for i, cache_key in batch]
+				# started by the worker that picks the batch up, not while it's queued
+				budget = magpie.budget.Budget(timeout * len(batch), started=False)
+				
+				if self._executor_for(plug) == "process" and self._process_pool != None:
+					pending = self._process_pool.submit_batch(plug, batch_documents, compiled, budget.seconds + grace, budget)
+				else:
+					pending = self._thread_pool.submit(magpie.budget.call, plug.process_batch, (batch_documents, compiled), budget)
+				
+				batches.append((plug, batch, pending, budget))
 		
+		for plug, batch, pending, budget in batches:
 			try:
-				document.add_results(plug.process_upload(document, cfg))
+				pending.wait_started()
+				started = pending.started_at if pending.started_at != None else time.time()
+				results = pending.result(max(0, started + budget.seconds + grace - time.time()))
+				if results == None or len(results) != len(batch):
+					raise ValueError("process_batch returned {} results for {} documents".format(
+						"no" if results == None else len(results), len(batch)))
+				
+				for (i, cache_key), result in zip(batch, results):
+					if cache_key != None and result != None and not _timed_out(result):
+						self._result_cache.put(cache_key, result)
+					outcomes[(i, plug)] = result
+			except magpie.workers.WorkerTimeout:
+				pending.cancel()
+				for i, cache_key in batch:
+					self._logger.error("{} timed out on {}".format(plug.get_name(), documents[i]._document_id))
+					timed_out = magpie.tap.TestAnythingProtocol(plug.get_name())
+					timed_out.skip_test("Checking took longer than {} seconds".format(timeout))
+					outcomes[(i, plug)] = timed_out
+			except magpie.workers.WorkerCrashed:
+				for i, cache_key in batch:
+					self._logger.error("{} crashed on {}".format(plug.get_name(), documents[i]._document_id))
+					crashed = magpie.tap.TestAnythingProtocol(plug.get_name())
+					crashed.fail("Checking crashed, the submission may be too large or malformed")
+					outcomes[(i, plug)] = crashed
 			except Exception as e:
 				print("Failed loading {}".format(plug.get_name()))
 				print(str(e))
 				traceback.print_exc()
-		return document
+		
+		for i, document in enumerate(documents):
+			for plug in routes[i]:
+				document.add_results(outcomes.get((i, plug), None))
+		
+		return documents
 		
 	
 	def call_function(self, function, minutes):
@@ -296,62 +796,160 @@ class Magpie:
 		not still executing from the last time it was run.
 		
 		'''
-		self._tasks[function] = minutes
+		self.schedule(function, minutes * 60)
+	
+	def schedule(self, function, seconds, jitter=0, overlap=magpie.scheduler.OVERLAP_SKIP):
+		''' Calls the given function every x seconds, plus up to jitter 
+		seconds, on the scheduler's worker threads. overlap is one of the 
+		magpie.scheduler.OVERLAP_* policies deciding what happens if the last
+		call is still running.
+		
+		Returns the <magpie.scheduler.ScheduledTask>.
+		'''
+		return self._scheduler.schedule(function, seconds, jitter, overlap)
+	
+	def task_stats(self):
+		'''Returns a list of dictionaries with statistics about each 
+		scheduled task.'''
+		return self._scheduler.stats()
+	
+	def mark_config_dirty(self):
+		'''Call after changing any configuration so it gets written to disk.
+		
+		Writes are delayed until there have been no changes for 
+		ConfigWriteDelay seconds, so bursts of changes are written once, but 
+		never by more than ConfigWriteMaxDelay seconds.
+		'''
+		with self._config_lock:
+			now = time.time()
+			self._config_version += 1
+			self._config_last_change = now
+			if self._config_first_change == None:
+				self._config_first_change = now
+	
+	def flush_config(self):
+		'''Writes the configuration if it has changed and is due to be 
+		written.'''
+		with self._config_lock:
+			if self._config_first_change == None:
+				return
+			
+			now = time.time()
+			quiet = now - self._config_last_change >= self.global_config("ConfigWriteDelay", 5)
+			overdue = now - self._config_first_change >= self.global_config("ConfigWriteMaxDelay", 60)
+			
+			if not (quiet or overdue):
+				return
+		
+		self.write_config()
 	
 	@log_results
 	def write_config(self):
-		'''Writes the configuration to a file.'''
+		'''Writes the configuration to a file, test configurations are 
+		saved to their own store as they change.'''
+		
+		with self._config_lock:
+			version = self._config_version
 		
 		cfg = {
-			'tests':self.test_configurations,
 			'magpie':self.magpie_configuration,
-			'plugins':{}
+			'plugins':dict(self.plugin_configuration) # keeps unloaded plugins' configs
 		}
 
 		with self._loaded_plugins_lock:
 			for plug in self._loaded_plugins:
 				cfg['plugins'][plug.get_name()] = plug.get_config()
 		
-		with open(CONFIG_FILE_LOCATION, 'w') as output:
-			json.dump(cfg, output, sort_keys=True, indent=4, separators=(',', ': '))
+		magpie.config.atomic_write_json(CONFIG_FILE_LOCATION, cfg)
+		
+		with self._config_lock:
+			self._written_config_version = max(version, self._written_config_version)
+			if self._written_config_version == self._config_version:
+				self._config_first_change = None
+				self._config_last_change = None
 		
 	
-	@log_results
-	def shutdown(self):
-		self.write_config()
-
-
-
-def load_plugins(plugin_path, instance):
-	'''Loads a set of plugins at the given path.
+	def _terminate(self, signum, frame):
+		'''Handles SIGTERM by shutting down like Ctrl-C does.'''
+		raise SystemExit("Received signal {}".format(signum))
 	
-	Arguments:
-	plugin_path - the OS path to look for plugins at.
-	instance - classes of this instance will be returned
-	'''
-	plugins = []
-	plugin_dir = os.path.realpath(plugin_path)
-	sys.path.append(plugin_dir)
+	def __resume_jobs(self):
+		'''Requeues the jobs the journal says weren't delivered when Magpie 
+		last stopped, whether it shut down or crashed.'''
+		if self._journal == None:
+			return
+		
+		entries = self._journal.unfinished()
+		for entry in entries:
+			document = magpie.comm.Document.from_record(entry["document"])
+			if document == None:
+				self._logger.error("Files for job {} are gone, not resuming it".format(entry["job"]))
+				self._journal.record(entry["job"], magpie.journal.JOB_FAILED, error="files missing")
+				continue
+			
+			self._jobs.submit_batch([document], entry["configuration_type"], 
+				job_ids=[entry["job"]], listeners=entry.get("listeners"))
+		
+		if len(entries) > 0:
+			self._logger.info("Resumed {} unfinished jobs".format(len(entries)))
+		self.compact_journal()
 	
-
+	def compact_journal(self):
+		'''Rewrites the journal without finished jobs once it has more than
+		JournalCompactEntries entries.'''
+		if self._journal.compact(self.global_config("JournalCompactEntries", 10000)):
+			self._logger.info("Compacted the job journal")
 	
-	for f in os.listdir(plugin_dir):
-		if f.endswith(".py"):
-			name = f[:-3]
-		elif os.path.isdir(os.path.join(plugin_dir, f)):
-			name = f
-		else:
-			continue
+	@log_results
+	def shutdown(self):
+		''' Shuts Magpie down without losing work:
+		
+		1. stops accepting new documents,
+		2. waits up to ShutdownTimeout seconds for queued jobs to finish, the
+		   journal has any that don't so they're resumed on the next start,
+		3. lets post processing finish in whatever time is left,
+		4. tears down every plugin,
+		5. stops the scheduler and worker pools,
+		6. writes the configuration and flushes the logs.
+		'''
+		if self._shutting_down:
+			return
+		self._shutting_down = True
 		
-		try:
-			mod = __import__(name, globals(), locals(), [], 0)
-
-			for piece in inspect.getmembers(mod):
-				if isinstance(piece, instance):
-					plugins.append(piece)
-
-		except ImportError as e:
-			print(e)
-			pass # problem importing
+		deadline = time.time() + self.global_config("ShutdownTimeout", 30)
+		remaining = lambda: max(0, deadline - time.time())
+		
+		if self._jobs != None:
+			self._jobs.close()
+			unfinished = self._jobs.drain(remaining())
+			if len(unfinished) > 0:
+				self._logger.warning("{} jobs didn't finish, they'll be resumed on restart".format(len(unfinished)))
+			self._jobs.shutdown(wait=False)
+		
+		if self._post_pool != None:
+			self._post_pool.shutdown(True, remaining())
+		
+		for plug in self.get_plugins():
+			try:
+				plug.teardown()
+			except Exception:
+				self._logger.exception("{} failed to tear down".format(plug.get_name()))
+		
+		self._scheduler.stop(True, remaining())
+		if self._watcher != None:
+			self._watcher.stop()
+		self._thread_pool.shutdown(False)
+		if self._process_pool != None:
+			self._process_pool.shutdown(True, remaining())
+		
+		for task in self.task_stats():
+			self._logger.info("Task {name} ran {runs} times, {failures} failed, {skipped} skipped".format(**task))
+		
+		self.write_config()
+		
+		if self._journal != None:
+			self._journal.compact()
+			self._journal.close()
 		
-	return plugins
+		for handler in self._logger.handlers:
+			handler.flush()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+'''
+This file is part of Magpie, an automated checking framework with multiple 
+submission forms; it was originally built for automatic grading, but has many
+more potential uses than that.
+
+Copyright 2013 Joseph Lewis <joehms22@gmail.com> | <joseph@josephlewis.net>
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following disclaimer
+  in the documentation and/or other materials provided with the
+  distribution.
+* Neither the name of the  nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import threading
+import time
+import uuid
+import collections
+import traceback
+
+import magpie.workers
+import magpie.journal
+
+JOB_QUEUED = "queued"
+JOB_GRADING = "grading"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+class QueueClosed(RuntimeError):
+	'''Raised when documents are submitted after the queue has been closed
+	for shutdown.'''
+	pass
+
+
+class Job(object):
+	''' A document waiting to be, or that has been, graded.
+	'''
+	job_id = None
+	document = None
+	configuration_type = None
+	state = None # one of JOB_QUEUED, JOB_GRADING, JOB_DONE or JOB_FAILED
+	error = None # the exception that caused the job to fail
+	listeners = None # names of the plugins still to be told it was graded, or None for all
+	
+	def __init__(self, document, configuration_type, job_id=None, listeners=None):
+		self.job_id = job_id if job_id != None else str(uuid.uuid4())
+		self.document = document
+		self.configuration_type = configuration_type
+		self.listeners = listeners
+		self.state = JOB_QUEUED
+		self._callbacks = []
+		self._finished = threading.Event()
+		self._lock = threading.Lock()
+	
+	def done(self):
+		'''Returns True if the job has finished, successfully or not.'''
+		return self._finished.is_set()
+	
+	def wait(self, timeout=None):
+		'''Waits for the job to finish, returns True if it did before the 
+		timeout.'''
+		return self._finished.wait(timeout)
+	
+	def add_callback(self, callback):
+		'''Calls callback(job) once the job is finished, right away if it 
+		already is.'''
+		with self._lock:
+			if not self.done():
+				self._callbacks.append(callback)
+				return
+		
+		callback(self)
+	
+	def _finish(self, state, error=None):
+		with self._lock:
+			self.state = state
+			self.error = error
+			self._finished.set()
+			callbacks = self._callbacks
+			self._callbacks = []
+		
+		for callback in callbacks:
+			try:
+				callback(self)
+			except Exception:
+				traceback.print_exc()
+
+
+class JobQueue(object):
+	''' Holds documents submitted for grading and hands them off to a pool of
+	grading workers.
+	
+	Finished jobs are remembered so frontends can come back for them, only
+	the most recent history jobs are kept.
+	
+	If a <magpie.journal.Journal> is given each job's progress is recorded
+	in it so it can be resumed after a crash.
+	'''
+	
+	def __init__(self, grade_function, workers, history, logger, journal=None, graded_function=None):
+		'''grade_function(documents, configuration_type) is called by the 
+		workers to grade a list of documents, one for each submit call or
+		all of a submit_batch call at once. graded_function(job), if given,
+		is called with each job that was graded successfully.'''
+		self._grade = grade_function
+		self._graded = graded_function
+		self._journal = journal
+		self._history = history
+		self._logger = logger
+		self._jobs = collections.OrderedDict()
+		self._jobs_lock = threading.Lock()
+		self._closed = False
+		self._workers = magpie.workers.ThreadPool(workers, "Grading Worker")
+	
+	def submit(self, document, configuration_type, callback=None):
+		'''Queues the document for grading and returns the id of its job.'''
+		return self.submit_batch([document], configuration_type, callback)[0]
+	
+	def submit_batch(self, documents, configuration_type, callback=None, job_ids=None, listeners=None):
+		'''Queues the documents to be graded together and returns the ids of
+		their jobs, each document still gets its own job. job_ids, and the 
+		listeners still to be told about them, can be given to resume jobs 
+		from before a restart.
+		
+		Raises QueueClosed once the queue has been closed.
+		'''
+		if job_ids == None:
+			job_ids = [None for document in documents]
+		
+		jobs = [Job(document, configuration_type, job_id, listeners) for document, job_id in zip(documents, job_ids)]
+		if len(jobs) == 0:
+			return []
+		
+		for job in jobs:
+			if callback != None:
+				job.add_callback(callback)
+		
+		with self._jobs_lock:
+			if self._closed:
+				raise QueueClosed("Not accepting documents, shutting down")
+			
+			for job in jobs:
+				self._jobs[job.job_id] = job
+			self._forget_old_jobs()
+		
+		fields = {} if listeners == None else {"listeners":listeners}
+		for job in jobs:
+			self._record(job, magpie.journal.JOB_RECEIVED, 
+				configuration_type=configuration_type, 
+				document=job.document.to_record(), **fields)
+		
+		self._workers.submit(self._run, jobs)
+		return [job.job_id for job in jobs]
+	
+	def get(self, job_id):
+		'''Returns the job with the given id, or None if it is unknown.'''
+		with self._jobs_lock:
+			return self._jobs.get(job_id, None)
+	
+	def _forget_old_jobs(self):
+		'''Drops the oldest finished jobs once there are more than history.
+		Must hold _jobs_lock.'''
+		extra = len(self._jobs) - self._history
+		
+		for job_id, job in list(self._jobs.items()):
+			if extra <= 0:
+				break
+			
+			if job.done():
+				del self._jobs[job_id]
+				extra -= 1
+	
+	def _record(self, job, state, **fields):
+		'''Records the job's new state in the journal, if there is one.'''
+		if self._journal != None:
+			self._journal.record(job.job_id, state, **fields)
+	
+	def _run(self, jobs):
+		for job in jobs:
+			job.state = JOB_GRADING
+			self._record(job, magpie.journal.JOB_GRADING)
+		
+		try:
+			self._grade([job.document for job in jobs], jobs[0].configuration_type)
+		except Exception as e:
+			self._logger.exception("Grading job {} failed".format(", ".join(job.job_id for job in jobs)))
+			for job in jobs:
+				self._record(job, magpie.journal.JOB_FAILED, error=str(e))
+				job._finish(JOB_FAILED, e)
+			return
+		
+		for job in jobs:
+			self._record(job, magpie.journal.JOB_GRADED)
+			job._finish(JOB_DONE)
+			if self._graded != None:
+				self._graded(job)
+	
+	def close(self):
+		'''Stops accepting new documents, ones already queued are still 
+		graded.'''
+		with self._jobs_lock:
+			self._closed = True
+	
+	def is_closed(self):
+		return self._closed
+	
+	def unfinished(self):
+		'''Returns the jobs that haven't finished yet, oldest first.'''
+		with self._jobs_lock:
+			return [job for job in self._jobs.values() if not job.done()]
+	
+	def drain(self, timeout):
+		'''Waits up to timeout seconds for every queued job to finish, 
+		returns the jobs that didn't.'''
+		deadline = time.time() + timeout
+		for job in self.unfinished():
+			job.wait(max(0, deadline - time.time()))
+		return self.unfinished()
+	
+	def shutdown(self, wait=True):
+		self._workers.shutdown(wait)
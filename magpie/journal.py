@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+'''
+This file is part of Magpie, an automated checking framework with multiple 
+submission forms; it was originally built for automatic grading, but has many
+more potential uses than that.
+
+Copyright 2013 Joseph Lewis <joehms22@gmail.com> | <joseph@josephlewis.net>
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following disclaimer
+  in the documentation and/or other materials provided with the
+  distribution.
+* Neither the name of the  nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import json
+import os
+import threading
+import time
+
+import magpie.config
+
+JOB_RECEIVED = "received"
+JOB_GRADING = "grading"
+JOB_GRADED = "graded"
+JOB_DELIVERED = "delivered"
+JOB_UNDELIVERED = "undelivered" # some plugins' post processing failed
+JOB_FAILED = "failed"
+
+FINISHED_STATES = (JOB_DELIVERED, JOB_FAILED)
+
+
+class Journal(object):
+	''' An append only log of what has happened to each job, one JSON object
+	per line, so jobs that were in progress when Magpie died can be resumed.
+	
+	A job is received (with everything needed to rebuild it), grading, 
+	graded, then delivered once post processing is done, or failed. Jobs 
+	that aren't delivered or failed are unfinished. If some plugins fail 
+	post processing the job is undelivered, their names are added to its
+	received entry as "listeners" so only they are told when it's resumed.
+	
+	The unfinished jobs are also kept in memory so compact can rewrite the
+	file with just them without reading it again.
+	'''
+	
+	def __init__(self, path, sync=True):
+		'''If sync is True every entry is fsynced before record returns.'''
+		self._path = path
+		self._sync = sync
+		self._lock = threading.Lock()
+		self._entries = 0
+		self._unfinished = self._replay()
+		self._file = open(path, 'a')
+	
+	def _replay(self):
+		'''Reads the journal, returns a dict of job id -> received entry for
+		unfinished jobs.'''
+		unfinished = {}
+		try:
+			with open(self._path) as journal:
+				for line in journal:
+					self._entries += 1
+					try:
+						entry = json.loads(line)
+					except ValueError:
+						continue # half written when the process died
+					
+					self._update(unfinished, entry)
+		except IOError:
+			pass
+		return unfinished
+	
+	def unfinished(self):
+		'''Returns the received entries of unfinished jobs, oldest first.'''
+		with self._lock:
+			return sorted(self._unfinished.values(), key=lambda entry: entry["time"])
+	
+	def record(self, job_id, state, **fields):
+		'''Appends an entry saying the job is now in state, fields are 
+		saved with it.'''
+		entry = dict(fields)
+		entry["job"] = job_id
+		entry["state"] = state
+		entry["time"] = time.time()
+		
+		with self._lock:
+			self._write(entry)
+			self._update(self._unfinished, entry)
+	
+	def _update(self, unfinished, entry):
+		'''Applies entry to unfinished, a dict of job id -> received entry.'''
+		job_id, state = entry["job"], entry["state"]
+		if state == JOB_RECEIVED:
+			unfinished[job_id] = entry
+		elif state in FINISHED_STATES:
+			unfinished.pop(job_id, None)
+		elif state == JOB_UNDELIVERED and job_id in unfinished:
+			unfinished[job_id] = dict(unfinished[job_id], listeners=entry["listeners"])
+	
+	def _write(self, entry):
+		'''Must hold _lock.'''
+		if self._file.closed: # after shutdown, the job will be resumed
+			return
+		self._file.write(json.dumps(entry, sort_keys=True) + "\n")
+		self._file.flush()
+		if self._sync:
+			os.fsync(self._file.fileno())
+		self._entries += 1
+	
+	def compact(self, min_entries=0):
+		'''Rewrites the journal with only the unfinished jobs, if it has more
+		than min_entries entries. Returns True if it was rewritten.'''
+		with self._lock:
+			if self._file.closed or self._entries <= min_entries:
+				return False
+			
+			entries = sorted(self._unfinished.values(), key=lambda entry: entry["time"])
+			data = "".join(json.dumps(entry, sort_keys=True) + "\n" for entry in entries)
+			magpie.config.atomic_write(self._path, data.encode('utf-8'))
+			
+			self._file.close()
+			self._file = open(self._path, 'a')
+			self._entries = len(entries)
+			return True
+	
+	def close(self):
+		with self._lock:
+			self._file.close()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+'''
+This file is part of Magpie, an automated checking framework with multiple 
+submission forms; it was originally built for automatic grading, but has many
+more potential uses than that.
+
+Copyright 2013 Joseph Lewis <joehms22@gmail.com> | <joseph@josephlewis.net>
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following disclaimer
+  in the documentation and/or other materials provided with the
+  distribution.
+* Neither the name of the  nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import importlib
+import inspect
+import json
+import os
+import threading
+
+from magpie.plugins.abstract_plugin import AbstractPlugin
+import magpie.budget
+import magpie.config
+
+MANIFEST_VERSION = 1
+
+
+def module_names(plugin_dir):
+	'''Returns a sorted list of (module name, path) for every module and 
+	package in the plugin directory.'''
+	modules = []
+	for f in sorted(os.listdir(plugin_dir)):
+		path = os.path.join(plugin_dir, f)
+		if f.endswith(".py"):
+			modules.append((f[:-3], path))
+		elif os.path.isdir(path) and os.path.exists(os.path.join(path, "__init__.py")):
+			modules.append((f, path))
+	return modules
+
+
+def module_mtime(path):
+	'''Returns the newest modification time of the module, or of any Python
+	file in the package.'''
+	if not os.path.isdir(path):
+		return os.path.getmtime(path)
+	
+	newest = os.path.getmtime(path)
+	for directory, dirs, files in os.walk(path):
+		for f in files:
+			if f.endswith(".py"):
+				newest = max(newest, os.path.getmtime(os.path.join(directory, f)))
+	return newest
+
+
+def plugin_classes(module):
+	'''Returns the plugin classes defined in the module.'''
+	return [cls for name, cls in inspect.getmembers(module, inspect.isclass)
+		if issubclass(cls, AbstractPlugin) and cls is not AbstractPlugin and cls.__module__ == module.__name__]
+
+
+def describe(plugin):
+	'''Returns the manifest entry for a plugin instance.'''
+	return {
+		"class":type(plugin).__name__,
+		"name":plugin.get_name(),
+		"version":plugin.get_version(),
+		"author":plugin.get_author(),
+		"license":plugin.get_license(),
+		"capabilities":plugin.get_capabilities(),
+		"default_config":plugin._default_config,
+		"default_test":plugin.get_default_test_configuration()
+	}
+
+
+class PluginManifest(object):
+	''' A cache of what each module in the plugins directory contains, so 
+	modules only need to be imported when their plugins are going to be 
+	used.
+	
+	Entries are keyed by module name and record the module's path and 
+	modification time; an entry is stale once the module changes.
+	'''
+	
+	def __init__(self, path):
+		self._path = path
+		self._modules = {}
+		self._changed = False
+		
+		try:
+			with open(path) as manifest:
+				data = json.load(manifest)
+			if data.get("version", None) == MANIFEST_VERSION:
+				self._modules = data.get("modules", {})
+		except (IOError, ValueError):
+			self._changed = True
+	
+	def lookup(self, module_name, path, mtime):
+		'''Returns the list of plugin entries for the module, or None if the
+		module isn't in the manifest or has changed since.'''
+		entry = self._modules.get(module_name, None)
+		if entry == None or entry["path"] != path or entry["mtime"] != mtime:
+			return None
+		return entry["plugins"]
+	
+	def record(self, module_name, path, mtime, plugins):
+		'''Records the plugin entries found in the module.'''
+		self._modules[module_name] = {"path":path, "mtime":mtime, "plugins":plugins}
+		self._changed = True
+	
+	def retain(self, module_names):
+		'''Forgets modules that are no longer in the plugins directory.'''
+		for name in list(self._modules.keys()):
+			if name not in module_names:
+				del self._modules[name]
+				self._changed = True
+	
+	def save(self):
+		'''Writes the manifest if anything changed.'''
+		if self._changed:
+			magpie.config.atomic_write_json(self._path, {"version":MANIFEST_VERSION, "modules":self._modules})
+			self._changed = False
+
+
+class LazyPlugin(AbstractPlugin):
+	''' Stands in for a plugin that hasn't been imported yet, using what the
+	manifest knows about it. The real plugin is imported and set up the 
+	first time it is given a document.
+	'''
+	
+	def __init__(self, module_name, entry, logger, core):
+		AbstractPlugin.__init__(self, entry["name"], entry["author"], 
+			entry["version"], entry["license"], entry["default_config"],
+			entry["default_test"])
+		self._module_name = module_name
+		self._class_name = entry["class"]
+		self._capabilities = entry["capabilities"]
+		self._plugin = None
+		self._plugin_lock = threading.Lock()
+		self._logger = logger
+		self._magpie = core
+	
+	def setup(self, config, logger, core):
+		'''Holds on to the setup arguments until the plugin is needed.'''
+		self._logger = logger
+		self._magpie = core
+		self.update_config(config)
+	
+	def get_plugin(self):
+		'''Returns the real plugin, importing and setting it up if needed.'''
+		with self._plugin_lock:
+			if self._plugin == None:
+				self._logger.info("Importing {} on first use".format(self.get_name()))
+				module = importlib.import_module(self._module_name)
+				plugin = getattr(module, self._class_name)()
+				plugin.setup(self._config, self._logger, self._magpie)
+				self._plugin = plugin
+			return self._plugin
+	
+	def is_loaded(self):
+		return self._plugin != None
+	
+	def get_class_key(self):
+		return (self._module_name, self._class_name)
+	
+	def get_capabilities(self):
+		return self._capabilities
+	
+	def teardown(self):
+		if self._plugin != None:
+			self._plugin.teardown()
+	
+	def update_config(self, config):
+		AbstractPlugin.update_config(self, config)
+		if self._plugin != None:
+			self._plugin.update_config(config)
+	
+	def get_config(self):
+		if self._plugin != None:
+			return self._plugin.get_config()
+		return self._config
+	
+	def compile_test_configuration(self, test_configuration):
+		return self.get_plugin().compile_test_configuration(test_configuration)
+	
+	def process_upload(self, upload, test_configuration, budget=None):
+		return magpie.budget.call(self.get_plugin().process_upload, (upload, test_configuration), budget)
+	
+	def process_batch(self, uploads, test_configuration, budget=None):
+		return magpie.budget.call(self.get_plugin().process_batch, (uploads, test_configuration), budget)
+	
+	def upload_processed(self, upload):
+		if self._plugin != None:
+			self._plugin.upload_processed(upload)
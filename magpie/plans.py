@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+'''
+This file is part of Magpie, an automated checking framework with multiple 
+submission forms; it was originally built for automatic grading, but has many
+more potential uses than that.
+
+Copyright 2013 Joseph Lewis <joehms22@gmail.com> | <joseph@josephlewis.net>
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following disclaimer
+  in the documentation and/or other materials provided with the
+  distribution.
+* Neither the name of the  nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import threading
+
+import magpie.cache
+
+
+class FrozenDict(dict):
+	''' A dict that can't be changed once it's made, so a test plan can be
+	shared between grading threads without copying or locking.
+	'''
+	
+	def _read_only(self, *args, **kwargs):
+		raise TypeError("FrozenDict can't be changed")
+	
+	__setitem__ = _read_only
+	__delitem__ = _read_only
+	clear = _read_only
+	pop = _read_only
+	popitem = _read_only
+	setdefault = _read_only
+	update = _read_only
+	
+	def __reduce__(self):
+		return (FrozenDict, (dict(self),))
+
+
+def freeze(value):
+	'''Returns an immutable copy of a JSON like value, dicts become 
+	FrozenDicts and lists become tuples.'''
+	if isinstance(value, dict):
+		return FrozenDict((key, freeze(item)) for key, item in value.items())
+	if isinstance(value, (list, tuple)):
+		return tuple(freeze(item) for item in value)
+	return value
+
+
+class PluginPlan(object):
+	''' What one plugin does for a test: its frozen test configuration, the
+	hash of it used in result cache keys, and the plan the plugin compiled
+	from it that is handed to process_upload and process_batch.
+	
+	Plugins that haven't been imported yet are compiled on first use.
+	'''
+	__slots__ = ('plugin', 'configuration', 'configuration_hash', '_compiled', '_lock')
+	
+	def __init__(self, plugin, configuration):
+		self.plugin = plugin
+		self.configuration = freeze(configuration)
+		self.configuration_hash = magpie.cache.hash_configuration(self.configuration)
+		self._compiled = None
+		self._lock = threading.Lock()
+		
+		if plugin.is_loaded():
+			try:
+				self.compiled()
+			except Exception:
+				pass # raised again when the plan is used
+	
+	def compiled(self):
+		'''Returns the plugin's compiled plan, compiling it if needed.'''
+		if self._compiled == None:
+			with self._lock:
+				if self._compiled == None:
+					self._compiled = (self.plugin.compile_test_configuration(self.configuration),)
+		return self._compiled[0]
+
+
+class TestPlan(object):
+	''' An immutable, compiled version of a test configuration, built when 
+	the test is loaded or edited so grading only has to look plugins up.
+	'''
+	
+	def __init__(self, name, configuration, plugins):
+		'''Compiles configuration, a dict of plugin identifier -> test 
+		configuration, for each of the plugins. Plugins without a section 
+		use their default test configuration.'''
+		self.name = name
+		self.empty = len(configuration) == 0
+		self._plans = {}
+		
+		for plugin in plugins:
+			section = configuration.get(plugin.get_name_version(), None)
+			if section == None:
+				section = plugin.get_default_test_configuration()
+			self._plans[plugin.get_name()] = PluginPlan(plugin, section)
+	
+	def for_plugin(self, plugin):
+		'''Returns the <PluginPlan> for the plugin.'''
+		return self._plans[plugin.get_name()]
+
+
+class ConfigurationSnapshot(object):
+	''' An immutable view of every test configuration, its version and its
+	compiled plan at one point in time.
+	
+	Readers take the current snapshot and use it without locking; writers
+	build a new snapshot with with_test or without_test and publish it with
+	a single assignment, so a reader sees either all of a change or none 
+	of it.
+	'''
+	
+	def __init__(self, tests, versions, plans):
+		self.tests = tests # FrozenDict of test name -> frozen configuration
+		self.versions = versions # FrozenDict of test name -> version
+		self.plans = plans # FrozenDict of test name -> <TestPlan>
+	
+	@staticmethod
+	def build(records, plugins):
+		'''Returns a snapshot of records, a dict of test name -> (version,
+		configuration), with plans compiled for the plugins.'''
+		tests = FrozenDict((name, freeze(config)) for name, (version, config) in records.items())
+		versions = FrozenDict((name, version) for name, (version, config) in records.items())
+		plans = FrozenDict((name, TestPlan(name, config, plugins)) for name, config in tests.items())
+		return ConfigurationSnapshot(tests, versions, plans)
+	
+	def with_test(self, name, config, version, plugins):
+		'''Returns a copy of this snapshot with the named test set to config
+		and its plan recompiled.'''
+		config = freeze(config)
+		return ConfigurationSnapshot(self._replace(self.tests, name, config),
+			self._replace(self.versions, name, version),
+			self._replace(self.plans, name, TestPlan(name, config, plugins)))
+	
+	def without_test(self, name):
+		'''Returns a copy of this snapshot without the named test.'''
+		return ConfigurationSnapshot(self._remove(self.tests, name),
+			self._remove(self.versions, name),
+			self._remove(self.plans, name))
+	
+	def plan_for(self, configuration_type, default_name, plugins):
+		'''Returns the plan for the configuration type, falling back to the
+		default test if it doesn't exist or is empty, and to every plugin's
+		default test configuration if there isn't a default test.'''
+		plan = self.plans.get(configuration_type, None)
+		if plan == None or plan.empty:
+			plan = self.plans.get(default_name, None)
+		if plan == None:
+			plan = TestPlan(default_name, {}, plugins)
+		return plan
+	
+	@staticmethod
+	def _replace(mapping, key, value):
+		items = dict(mapping)
+		items[key] = value
+		return FrozenDict(items)
+	
+	@staticmethod
+	def _remove(mapping, key):
+		return FrozenDict((k, v) for k, v in mapping.items() if k != key)
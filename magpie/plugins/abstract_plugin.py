@@ -34,11 +34,33 @@ THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 '''
 
+import magpie.artifacts
+import magpie.budget
+
+DEFAULT_CAPABILITIES = {
+	'role':'backend', # frontends submit documents, backends grade them
+	'lazy':False, # if True, the plugin isn't imported until its first document
+	
+	# backends are only given documents with a file matching one of these,
+	# or every document if none are given. See magpie.routing.
+	'extensions':[], # e.g. ".sb2"
+	'mime_types':[], # e.g. "application/zip"
+	'magic':[] # bytes the file starts with, e.g. "PK\x03\x04"
+}
+
 class AbstractPlugin(object):
 	''' The plugin that is set to handle all information coming in and going
 	from this system.
 	
+	Subclasses describe themselves by overriding CAPABILITIES, see 
+	DEFAULT_CAPABILITIES for the keys.
+	
+	Subclasses can also override ARTIFACTS, a dict of artifact name -> 
+	(producer, artifact type), to provide artifacts any plugin can get 
+	from a document with Document.get_artifact, see magpie.artifacts.
 	'''
+	CAPABILITIES = {}
+	ARTIFACTS = {}
 	_config = None
 	_logger = None
 	_magpie = None
@@ -60,6 +82,9 @@ class AbstractPlugin(object):
 		self._default_config = default_config
 		self._default_test = default_test
 		
+		for name, (producer, artifact_type) in self.ARTIFACTS.items():
+			magpie.artifacts.register(name, producer, artifact_type)
+		
 		# convert everything to unicode for consistency with the JSON loader.
 		for key, value in self._default_config.items():
 			if type(value) == type(''):
@@ -108,6 +133,26 @@ class AbstractPlugin(object):
 		'''
 		return self._config
 	
+	def config_changed(self):
+		'''Call after changing self._config outside of update_config so the
+		core knows to save it.'''
+		if self._magpie != None:
+			self._magpie.mark_config_dirty()
+	
+	def compile_test_configuration(self, test_configuration):
+		'''Called once when a test configuration is loaded or changed with 
+		this plugin's section of it, frozen so it can't be changed; whatever
+		is returned is given to process_upload and process_batch as their 
+		test_configuration.
+		
+		Override this to do work that only depends on the configuration, 
+		like deciding which checks to run, once instead of on every upload.
+		The result must be picklable to be sent to process workers.
+		
+		By default, returns test_configuration unchanged.
+		'''
+		return test_configuration
+	
 	def process_upload(self, upload, test_configuration):
 		'''Called when an upload has been input in to the program.
 		
@@ -121,11 +166,36 @@ class AbstractPlugin(object):
 		it is thus critical that you not modify external variables to avoid
 		race conditions and concurrent modification while it is running.
 		
+		If you add a budget keyword argument it is given a 
+		<magpie.budget.Budget>; once it has expired, report the checks you 
+		haven't run with TestAnythingProtocol.skip_test and return. Plugins 
+		still running PluginTimeoutGrace seconds after their budget are 
+		stopped and get a single skipped result.
+		
 		'''
 		pass
 	
+	def process_batch(self, uploads, test_configuration, budget=None):
+		'''Called with a list of uploads that are all graded with the same
+		test configuration and share one budget, see process_upload.
+		
+		Returns a list with what process_upload would have returned for 
+		each upload, in the same order.
+		
+		By default, calls process_upload on each upload; override this if 
+		setup or parsing can be shared between uploads.
+		'''
+		return [magpie.budget.call(self.process_upload, (upload, test_configuration), budget) for upload in uploads]
+	
 	def upload_processed(self, upload):
-		'''Called after process_upload has been completed on the upload.'''
+		'''Called after process_upload has been completed on the upload.
+		
+		Every plugin that graded the upload and every frontend is called 
+		once the upload's results are in, on the core's post processing 
+		threads; frontends should check upload.frontend to see if the upload
+		is theirs. Slow work like sending results belongs here rather than
+		in process_upload.
+		'''
 		pass
 	
 	def get_name(self):
@@ -148,6 +218,22 @@ class AbstractPlugin(object):
 		'''Returns the license of the plugin.'''
 		return self._license
 	
+	def get_capabilities(self):
+		'''Returns the plugin's capabilities, CAPABILITIES filled in with
+		DEFAULT_CAPABILITIES.'''
+		capabilities = dict(DEFAULT_CAPABILITIES)
+		capabilities.update(self.CAPABILITIES)
+		return capabilities
+	
+	def is_loaded(self):
+		'''Returns False if the plugin's code hasn't been imported yet.'''
+		return True
+	
+	def get_class_key(self):
+		'''Returns a tuple of (module name, class name) that can be used to
+		import the plugin in another process.'''
+		return (type(self).__module__, type(self).__name__)
+	
 	def get_default_test_configuration(self):
 		''' Gets a default configuration used for a test.
 		'''
@@ -33,15 +33,31 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 '''
 
 import magpie
-from flask import Flask, render_template, request, url_for, redirect
+import magpie.storage
+import magpie.config
+import magpie.jobs
+import magpie.serializers
+from flask import Flask, Response, render_template, request, url_for, redirect, abort, stream_with_context
+from werkzeug.serving import make_server
 from magpie.plugins.abstract_plugin import AbstractPlugin
 import threading
 import pprint
 import json
 
 frontend_instance = None # used by flask to access methods of HTTPFrontend2
+SHUTTING_DOWN = ("Magpie is restarting, please try again in a minute.", 503)
+STREAM_BUFFER = 20 # template pieces sent to the browser at once
 app = Flask(__name__)
 
+def stream_template(template_name, **context):
+	'''Like render_template, but renders the template a piece at a time as
+	it's sent so big pages start showing straight away without being held
+	in memory. Wrap it in stream_with_context.'''
+	app.update_template_context(context)
+	stream = app.jinja_env.get_template(template_name).stream(context)
+	stream.enable_buffering(STREAM_BUFFER)
+	return stream
+
 @app.route('/', methods=['GET', 'POST'])
 def upload_file():
 	try:
@@ -50,21 +66,62 @@ def upload_file():
 			return render_template('upload.html', tests=tests, **frontend_instance._config)
 
 		else: # POST
+			if not frontend_instance._magpie.is_accepting():
+				return SHUTTING_DOWN
+			
 			doc = magpie.comm.Document("No User", frontend_instance.get_name())
 
 			
 			file = request.files['upfile']
-			doc.add_file(file.filename,file)
+			try:
+				doc.add_file(file.filename, file.stream, file.mimetype)
+			except (magpie.storage.UploadTooLarge, magpie.storage.BadFilename) as e:
+				return render_template('upload.html', tests=frontend_instance._magpie.test_configurations.keys(), message=str(e), **frontend_instance._config)
 			
 			test = request.form['test']
-			frontend_instance._magpie.submit_document(doc, test)
-			return render_template('results.html', document=doc, **frontend_instance._config)
+			try:
+				job_id = frontend_instance._magpie.submit_document(doc, test)
+			except magpie.jobs.QueueClosed:
+				doc.discard()
+				return SHUTTING_DOWN
+			return redirect(url_for('results', job_id=job_id))
 
 	except Exception as e:
 		frontend_instance._logger.exception(e)
 		print("Exception")
 		return (str(e))
 
+@app.route('/results/<job_id>')
+def results(job_id):
+	job = frontend_instance._magpie.get_job(job_id)
+	if job == None:
+		abort(404)
+	
+	if not job.done():
+		return render_template('pending.html', job=job, **frontend_instance._config)
+	
+	return Response(stream_with_context(stream_template('results.html', document=job.document, 
+		job_id=job_id, formats=magpie.serializers.formats(), **frontend_instance._config)))
+
+@app.route('/results/<job_id>/<format_name>')
+def results_as(job_id, format_name):
+	'''Sends the results in one of the formats in magpie.serializers as 
+	they're written.'''
+	job = frontend_instance._magpie.get_job(job_id)
+	if job == None:
+		abort(404)
+	
+	try:
+		writer, mime_type, extension = magpie.serializers.get_format(format_name)
+	except magpie.serializers.UnknownFormat:
+		abort(404)
+	
+	if not job.done():
+		return render_template('pending.html', job=job, **frontend_instance._config)
+	
+	headers = {"Content-Disposition":"attachment; filename={}{}".format(job_id, extension)}
+	return Response(stream_with_context(job.document.serialize(format_name)), mimetype=mime_type, headers=headers)
+
 @app.route('/config', methods=['GET'])
 def configure_app():
 	contents = "<h3>Tests<h3>"
@@ -73,30 +130,60 @@ def configure_app():
 		contents += "<br><a href='{}'>Delete</a>".format(url_for('delete_test', test_name=testname))
 		contents += "<br><a href='{}'>Edit</a>".format(url_for('edit_test', test_name=testname))
 	
+	contents += "<h3>Scheduled Tasks</h3><table><tr><th>Task</th><th>Every (s)</th><th>Runs</th><th>Failures</th><th>Skipped</th><th>Last Duration (s)</th></tr>"
+	for task in frontend_instance._magpie.task_stats():
+		duration = "{:.2f}".format(task['last_duration']) if task['last_duration'] != None else ""
+		contents += "<tr><td>{name}</td><td>{interval}</td><td>{runs}</td><td>{failures}</td><td>{skipped}</td><td>{0}</td></tr>".format(duration, **task)
+	contents += "</table>"
+	
 	return render_template('configure.html', config = contents, **frontend_instance._config)
 
+def render_edit_test(test_name, msg=""):
+	core = frontend_instance._magpie
+	
+	# check to see if we're making a new config or editing an existing one
+	snapshot = core.get_configuration_snapshot()
+	if test_name not in snapshot.tests:
+		core.make_new_test_configuration(test_name)
+		snapshot = core.get_configuration_snapshot()
+	
+	# the test and its version come from the same snapshot so they match
+	testval = snapshot.tests.get(test_name, {})
+	version = snapshot.versions.get(test_name, None)
+	testval = json.dumps(testval, sort_keys=True, indent=4, separators=(',', ': '))
+	return render_template('edit_test.html', test_name=test_name, test_value=testval, test_version=version, msg=msg, **frontend_instance._config)
+
 @app.route('/edit/<test_name>', methods=['GET', 'POST'])
 def edit_test(test_name):
 	if request.method == 'GET':
-		# check to see if we're making a new config or editing an existing one
-		testval = frontend_instance._magpie.test_configurations.get(test_name, None)
-		if testval == None:
-			testval = frontend_instance._magpie.make_new_test_configuration(test_name)
-		
-		testval = json.dumps(testval, sort_keys=True, indent=4, separators=(',', ': '))
-		return render_template('edit_test.html', test_name=test_name, test_value=testval, msg="", **frontend_instance._config)
+		return render_edit_test(test_name)
 	else: # POST
-		testval = request.form['test']
-		print(testval)
-		newtests = json.loads(testval)
+		core = frontend_instance._magpie
+		newtests = json.loads(request.form['test'])
+		
+		try:
+			version = int(request.form['version'])
+		except (KeyError, ValueError):
+			version = None
+		
+		# only save the plugin sections that were changed
+		oldtests = core.test_configurations.get(test_name, {})
+		changes = dict((plugin, config) for plugin, config in newtests.items() if oldtests.get(plugin, None) != config)
+		for plugin in oldtests:
+			if plugin not in newtests:
+				changes[plugin] = None
+		
+		try:
+			core.update_test_configuration(test_name, changes, version)
+		except magpie.config.ConcurrentModification:
+			return render_edit_test(test_name, "Someone else changed this test while you were editing it, your changes were not saved.")
 		
-		frontend_instance._magpie.test_configurations[test_name] = newtests
 		return redirect(url_for('configure_app'))
 		
 @app.route('/delete/<test_name>')
 def delete_test(test_name):
 	if test_name in frontend_instance._magpie.test_configurations:
-		del frontend_instance._magpie.test_configurations[test_name]
+		frontend_instance._magpie.delete_test_configuration(test_name)
 	return redirect(url_for('configure_app'))
 
 @app.route('/newtest', methods=['POST'])
@@ -107,12 +194,6 @@ def new_test():
 		name = 'New Test'
 	return redirect(url_for('edit_test', test_name=name))
 
-def shutdown_server():
-    func = request.environ.get('werkzeug.server.shutdown')
-    if func is None:
-        raise RuntimeError('Not running with the Werkzeug Server')
-    func()
-
 DEFAULT_CONFIG = {
 	'port':8080, 
 	'host':'', 
@@ -120,10 +201,16 @@ DEFAULT_CONFIG = {
 	'title':"Magpie",
 	'results_header':"",
 	'results_tail':"",
-	'message_of_the_day':''
+	'message_of_the_day':'',
+	'enabled':True # set to false to run without the web interface
 	}
+RESTART_KEYS = ('host', 'port', 'enabled') # the server is restarted when these change
 
 class HTTPFrontend2(AbstractPlugin):
+	CAPABILITIES = {'role':'frontend'}
+	_server = None # the running werkzeug server, or None
+	_server_thread = None
+	
 	def __init__(self):
 		global frontend_instance
 		AbstractPlugin.__init__(self, "HTTP2", "Joseph Lewis <joehms22@gmail.com>", 0.1, "BSD 3 Clause", DEFAULT_CONFIG, {})
@@ -132,21 +219,46 @@ class HTTPFrontend2(AbstractPlugin):
 	def teardown(self):
 		'''Shuts down the plugin, should exit all threads and do all cleanup
 		needed before closing.'''
-
+		self._stop_server()
 		
 	def update_config(self, *args):
 		'''Called when the configuration for the plugin has been updated from
 		another source.
+		
+		The server is only restarted if one of RESTART_KEYS changed, the 
+		other settings are read on each request.
 		'''
+		old_config = self._config
 		AbstractPlugin.update_config(self, *args)
-		print("http2 updating config {}".format(self._config))
-		try:
-			shutdown_server()
-		except RuntimeError:
-			pass # not running yet.
+		self._logger.debug("HTTP2 config is now {}".format(self._config))
+		
+		if self._server != None and all(old_config[key] == self._config[key] for key in RESTART_KEYS):
+			return
+		
+		self._stop_server()
+		if not self._config['enabled']:
+			return
 		
 		self._logger.info("Starting HTTP2 Server on Port: http://{host}:{port}".format(**self._config))
-		background_thread = threading.Thread(target=app.run, kwargs={'host':self._config['host'], 'port':self._config['port'], 'threaded':True})
-		background_thread.daemon = True
-		background_thread.start()
+		try:
+			self._server = make_server(self._config['host'], self._config['port'], app, threaded=True)
+		except (IOError, OSError) as e:
+			self._logger.error("Couldn't start the HTTP2 server: {}".format(e))
+			return
+		
+		self._server_thread = threading.Thread(target=self._server.serve_forever)
+		self._server_thread.daemon = True
+		self._server_thread.start()
+	
+	def _stop_server(self):
+		'''Stops the server if it's running and frees its port.'''
+		if self._server == None:
+			return
+		
+		self._logger.info("Stopping HTTP2 Server")
+		self._server.shutdown()
+		self._server.server_close()
+		self._server_thread.join()
+		self._server = None
+		self._server_thread = None
 		
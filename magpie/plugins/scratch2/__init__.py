@@ -102,7 +102,19 @@ SCRATCH_TESTS = [
 ('Minimum Sprites', min_sprites, -1)
 ]
 
+SCRATCH_TESTS_BY_NAME = dict((test[0], test) for test in SCRATCH_TESTS)
+
+
+def parse_projects(document):
+	'''Returns a list of (path, Scratch2Project) for every Scratch 2 project
+	in the document.'''
+	return [(path, scratch2.decompiler.Scratch2Project(path)) 
+		for path in document.items() if path.endswith(".sb2")]
+
+
 class Scratch2Backend(AbstractPlugin):
+	CAPABILITIES = {'lazy':True, 'extensions':['.sb2']}
+	ARTIFACTS = {'scratch2.projects':(parse_projects, list)}
 	DEFAULT_CONFIG={}
 	DEFAULT_TEST_CONFIG = {
 		'enabled':True,
@@ -123,7 +135,21 @@ class Scratch2Backend(AbstractPlugin):
 		
 
 
-	def process_upload(self, upload, test_config):
+	def compile_test_configuration(self, test_config):
+		'''Returns a tuple of (test name, expected value) for the tests 
+		that are turned on, or None if the plugin is disabled for this 
+		test.'''
+		if test_config.get("enabled", False) == False:
+			return None
+		
+		checks = []
+		for item in SCRATCH_TESTS:
+			expected_value = test_config.get(item[0], item[2])
+			if expected_value >= 0:
+				checks.append((item[0], expected_value))
+		return tuple(checks)
+
+	def process_upload(self, upload, checks, budget=None):
 		'''Called when an upload has been input in to the program.
 		
 		Returns a dictionary with pairs corresponding to:
@@ -133,29 +159,38 @@ class Scratch2Backend(AbstractPlugin):
 		http://podwiki.hexten.net/TAP/TAP.html?page=TAP
 		
 		'''
+		return self.process_batch([upload], checks, budget)[0]
+	
+	def process_batch(self, uploads, checks, budget=None):
+		'''Grades each upload with the checks from 
+		compile_test_configuration, checks left once the budget runs out
+		are skipped.'''
+		if checks == None:
+			return [None for upload in uploads]
 		
-		if test_config.get("enabled", False) == False:
-			return None
-		
+		return [self._check_upload(upload, checks, budget) for upload in uploads]
+	
+	def _check_upload(self, upload, checks, budget):
+		'''Runs the checks on every Scratch 2 project in the upload.'''
+		if budget != None and budget.expired():
+			# don't spend time parsing projects there's no time to check
+			test = magpie.tap.TestAnythingProtocol("Scratch2 Checks")
+			for name, expected_value in checks:
+				test.skip_test(name)
+			return [test]
 		
-		print("Test config: {}".format(test_config))
 		tests = []
-		for path in upload.items():
-			if path.endswith(".sb2"):
-				scratch = scratch2.decompiler.Scratch2Project(path)
+		for path, scratch in upload.get_artifact('scratch2.projects'):
+			test = magpie.tap.TestAnythingProtocol("Scratch2 Checks")
+			for name, expected_value in checks:
+				if budget != None and budget.expired():
+					test.skip_test(name)
+					continue
+				
+				item = SCRATCH_TESTS_BY_NAME[name]
+				result = item[1](scratch, expected_value, *item[3:])
+				test.assert_true(result[0], result[1], result[1])
 				
-				test = magpie.tap.TestAnythingProtocol("Scratch2 Checks")
-				for item in SCRATCH_TESTS:
-					expected_value = test_config.get(item[0], item[2])
-					
-					if expected_value < 0:
-						continue
-					
-					fun = item[1]
-					result = fun(scratch, expected_value, *item[3:])
-					test.assert_true(result[0], result[1], result[1])
-					
-				tests.append(test)
+			tests.append(test)
 		
-		print("Test config: {}".format(test_config))
 		return tests
@@ -33,16 +33,41 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 '''
 import poplib
 import magpie.comm
+import magpie.jobs
+import magpie.storage
 import base64
+import binascii
 import smtplib
+import socket
+import threading
 from email import parser
 from magpie.plugins.abstract_plugin import AbstractPlugin
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
+BASE64_CHUNK_SIZE = 64 * 1024 # characters of encoded text to decode at once
+
+def iter_base64(encoded):
+	'''Decodes the base64 text a chunk at a time, yielding the decoded 
+	bytes so they can be written out as they're decoded rather than kept 
+	in memory next to the encoded text, which poplib has already read in 
+	full.'''
+	leftover = ''
+	for start in range(0, len(encoded), BASE64_CHUNK_SIZE):
+		piece = leftover + "".join(encoded[start:start + BASE64_CHUNK_SIZE].split())
+		usable = len(piece) - len(piece) % 4
+		leftover = piece[usable:]
+		
+		if usable > 0:
+			yield base64.b64decode(piece[:usable])
+	
+	if leftover:
+		yield base64.b64decode(leftover)
+
 class SMTPFrontend(AbstractPlugin):
 	'''Provides an email based frontend to the automated grading tool.
 	'''
+	CAPABILITIES = {'role':'frontend'}
 	DEFAULT_CONFIG = {
 		'username':u'somebody@gmail.com', 
 		'password':u'password', 
@@ -58,15 +83,27 @@ class SMTPFrontend(AbstractPlugin):
 		'enabled':False
 	}
 	
+	SMTP_KEYS = ('smtp_host', 'smtp_port', 'smtp_tls_enabled', 'username', 'password')
+	
 	def __init__(self):
 		AbstractPlugin.__init__(self, "SMTP Frontend", "Joseph Lewis <joehms22@gmail.com>", 0.1, "BSD 3 Clause", self.DEFAULT_CONFIG, {})
+		self._smtp_connections = {} # thread id -> (settings, SMTP connection)
+		self._smtp_lock = threading.Lock()
+	
+	def teardown(self):
+		'''Closes the post processing workers' SMTP connections.'''
+		with self._smtp_lock:
+			thread_ids = list(self._smtp_connections.keys())
+		for thread_id in thread_ids:
+			self._disconnect(thread_id)
 	
 	def setup(self, *args):
 		AbstractPlugin.setup(self, *args)
 		self._magpie.call_function(self.task, 1)
 	
 	def _process_uploads(self):
-		documents = []
+		'''Fetches new messages and queues their attachments for grading,
+		results are sent back as each one finishes.'''
 		# Connect to the server
 		if self._config['pop_tls_enabled']:
 			pop_conn = poplib.POP3_SSL(self._config['pop_host'], self._config['pop_port'])
@@ -75,41 +112,65 @@ class SMTPFrontend(AbstractPlugin):
 		pop_conn.user(self._config['username'])
 		pop_conn.pass_(self._config['password'])
 		
-		#Get messages from server:
-		messages = [pop_conn.retr(i) for i in range(1, len(pop_conn.list()[1]) + 1)]
-		
-
-		#Parse message intom an email object:
-		for mssg in ["\n".join(mssg[1]) for mssg in messages]:
-			message = parser.Parser().parsestr(mssg)
-			
-			doc = magpie.comm.Document(message['from'], self.get_name())
-			subj = message['Subject']
-			
-			test = ""
-			for key in self._magpie.test_configurations.keys():
-				if key.lower() in subj.lower():
-					test = key
-			
-			for part in message.walk():
-				fn = part.get_filename()
-				if fn == None:
-					continue
+		try:
+			#Get messages from server one at a time and parse them into email objects:
+			for i in range(1, len(pop_conn.list()[1]) + 1):
+				if not self._magpie.is_accepting():
+					break # shutting down, leave the rest on the server
 				
-				try:
-					finfo = base64.b64decode(part.get_payload())
-				except TypeError:
-					finfo = part.get_payload()
+				message = parser.Parser().parsestr("\n".join(pop_conn.retr(i)[1]))
+				
+				doc = magpie.comm.Document(message['from'], self.get_name())
+				subj = message['Subject']
+				
+				test = ""
+				for key in self._magpie.test_configurations.keys():
+					if key.lower() in subj.lower():
+						test = key
+				
+				for part in message.walk():
+					fn = part.get_filename()
+					if fn == None:
+						continue
+					
+					try:
+						if part.get('Content-Transfer-Encoding', '').lower() == 'base64':
+							try:
+								doc.add_file(fn, iter_base64(part.get_payload()), part.get_content_type())
+								continue
+							except (TypeError, binascii.Error):
+								pass # not really base64
+						
+						doc.add_file(fn, part.get_payload(), part.get_content_type())
+					except (magpie.storage.UploadTooLarge, magpie.storage.BadFilename) as e:
+						self._logger.warning(str(e))
 				
-				doc.add_file(fn, finfo)
-			self._magpie.submit_document(doc, key)
-			documents.append(doc)
-		pop_conn.quit()
-		return documents
+				try:
+					self._magpie.submit_document(doc, test)
+				except magpie.jobs.QueueClosed:
+					doc.discard()
+					break # started shutting down since the check above
+		finally:
+			pop_conn.quit()
 	
-	def _send_results(self, documents):
-		'''Sends the results of the uploads.
-		'''
+	def upload_processed(self, upload):
+		'''Emails the results back if the upload came in by email.'''
+		if upload.frontend == self.get_name():
+			self._send_results([upload])
+	
+	def _connect(self):
+		'''Returns the calling thread's SMTP connection, opening a new one if
+		it doesn't have one or the settings have changed, so each post 
+		processing worker logs in once rather than once per document.'''
+		thread_id = threading.current_thread().ident
+		settings = tuple(self._config[key] for key in self.SMTP_KEYS)
+		with self._smtp_lock:
+			current = self._smtp_connections.get(thread_id)
+		
+		if current != None:
+			if current[0] == settings:
+				return current[1]
+			self._disconnect(thread_id)
 		
 		if self._config['smtp_tls_enabled']:
 			smtp_conn = smtplib.SMTP_SSL(self._config['smtp_host'], self._config['smtp_port'])
@@ -120,6 +181,36 @@ class SMTPFrontend(AbstractPlugin):
 		smtp_conn.starttls()
 		smtp_conn.login(self._config['username'], self._config['password'])
 		
+		with self._smtp_lock:
+			self._smtp_connections[thread_id] = (settings, smtp_conn)
+		return smtp_conn
+	
+	def _disconnect(self, thread_id=None):
+		'''Closes a thread's SMTP connection, the calling thread's by 
+		default.'''
+		if thread_id == None:
+			thread_id = threading.current_thread().ident
+		with self._smtp_lock:
+			current = self._smtp_connections.pop(thread_id, None)
+		
+		if current != None:
+			try:
+				current[1].quit()
+			except (smtplib.SMTPException, socket.error):
+				current[1].close()
+	
+	def _send(self, to, message):
+		'''Sends message over this thread's connection, reconnecting once if
+		the server closed it while it was idle.'''
+		try:
+			self._connect().sendmail(self._config['username'], to, message)
+		except (smtplib.SMTPServerDisconnected, socket.error):
+			self._disconnect()
+			self._connect().sendmail(self._config['username'], to, message)
+	
+	def _send_results(self, documents):
+		'''Sends the results of the uploads.
+		'''
 		for document in documents:
 			msg = MIMEMultipart('alternative')
 			msg['Subject'] = self._config['reply_subject']
@@ -149,18 +240,15 @@ class SMTPFrontend(AbstractPlugin):
 			msg.attach(part1)
 			msg.attach(part2)
 
-			smtp_conn.sendmail(self._config['username'], document.user, msg.as_string())
-		
-		smtp_conn.quit()
+			self._send(document.user, msg.as_string())
 		
 	
 	def task(self):
 		'''Fetches new messages, processes them, and sends back results.'''
-		if not self._config['enabled']:
+		if not self._config['enabled'] or not self._magpie.is_accepting():
 			return
 		
-		outbox = self._process_uploads()
-		self._send_results(outbox)
+		self._process_uploads()
 		
 		
 	
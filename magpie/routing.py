@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+'''
+This file is part of Magpie, an automated checking framework with multiple 
+submission forms; it was originally built for automatic grading, but has many
+more potential uses than that.
+
+Copyright 2013 Joseph Lewis <joehms22@gmail.com> | <joseph@josephlewis.net>
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following disclaimer
+  in the documentation and/or other materials provided with the
+  distribution.
+* Neither the name of the  nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import mimetypes
+import os
+
+
+def _extension(path):
+	'''Returns the lower case extension of the path including the dot.'''
+	return os.path.splitext(path)[1].lower()
+
+
+def _magic_bytes(magic):
+	'''Converts a magic number from the manifest, where it's kept as a 
+	string, to bytes.'''
+	if isinstance(magic, bytes):
+		return magic
+	return magic.encode('latin-1')
+
+
+def _read_head(path, length):
+	'''Returns the first length bytes of the file, or empty bytes if it
+	can't be read.'''
+	try:
+		with open(path, 'rb') as f:
+			return f.read(length)
+	except (IOError, OSError):
+		return b''
+
+
+class DispatchIndex(object):
+	''' Finds the plugins that can grade a document from the capabilities 
+	they declare:
+	
+	role - frontends never get documents.
+	extensions - file extensions such as ".sb2".
+	mime_types - MIME types given by the frontend or guessed from the name.
+	magic - byte strings the start of the file must match.
+	
+	A backend that declares none of these gets every document, otherwise
+	it gets documents with at least one file that matches any of them.
+	'''
+	
+	def __init__(self, plugins):
+		self._order = {} # plugin -> position, so results keep load order
+		self._frontends = []
+		self._everything = []
+		self._by_extension = {}
+		self._by_mime_type = {}
+		self._by_magic = []
+		self._magic_length = 0
+		
+		for position, plugin in enumerate(plugins):
+			capabilities = plugin.get_capabilities()
+			self._order[plugin] = position
+			if capabilities.get('role', 'backend') != 'backend':
+				self._frontends.append(plugin)
+				continue
+			
+			extensions = capabilities.get('extensions', None) or []
+			mime_types = capabilities.get('mime_types', None) or []
+			magic = capabilities.get('magic', None) or []
+			
+			if len(extensions) + len(mime_types) + len(magic) == 0:
+				self._everything.append(plugin)
+				continue
+			
+			for extension in extensions:
+				self._by_extension.setdefault(extension.lower(), []).append(plugin)
+			
+			for mime_type in mime_types:
+				self._by_mime_type.setdefault(mime_type.lower(), []).append(plugin)
+			
+			for prefix in magic:
+				prefix = _magic_bytes(prefix)
+				self._by_magic.append((prefix, plugin))
+				self._magic_length = max(self._magic_length, len(prefix))
+	
+	def route(self, document):
+		'''Returns the plugins that should grade the document, in the order
+		they were loaded.'''
+		matched = set(self._everything)
+		
+		for path in document.items():
+			matched.update(self._by_extension.get(_extension(path), []))
+			
+			for mime_type in (document.mime_types.get(path, None), mimetypes.guess_type(path)[0]):
+				if mime_type != None:
+					matched.update(self._by_mime_type.get(mime_type.lower(), []))
+			
+			magic = [(prefix, plugin) for prefix, plugin in self._by_magic if plugin not in matched]
+			if len(magic) > 0:
+				head = _read_head(path, self._magic_length)
+				matched.update(plugin for prefix, plugin in magic if head.startswith(prefix))
+		
+		return sorted(matched, key=self._order.get)
+	
+	def listeners(self, document):
+		'''Returns the plugins told when the document has been graded: the
+		ones that graded it and every frontend, in the order they were 
+		loaded.'''
+		return sorted(set(self.route(document)).union(self._frontends), key=self._order.get)
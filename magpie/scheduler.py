@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+'''
+This file is part of Magpie, an automated checking framework with multiple 
+submission forms; it was originally built for automatic grading, but has many
+more potential uses than that.
+
+Copyright 2013 Joseph Lewis <joehms22@gmail.com> | <joseph@josephlewis.net>
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following disclaimer
+  in the documentation and/or other materials provided with the
+  distribution.
+* Neither the name of the  nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import heapq
+import itertools
+import random
+import threading
+import time
+
+import magpie.workers
+
+OVERLAP_SKIP = "skip" # don't run if the last run is still going
+OVERLAP_QUEUE = "queue" # run again once for every run that was missed
+OVERLAP_COALESCE = "coalesce" # run again once no matter how many were missed
+OVERLAP_POLICIES = (OVERLAP_SKIP, OVERLAP_QUEUE, OVERLAP_COALESCE)
+
+MAX_WAIT_S = 1 # longest the scheduler sleeps before checking for a stop
+
+
+class ScheduledTask(object):
+	''' A function the scheduler runs every interval seconds along with
+	statistics about how it has been running.
+	'''
+	
+	def __init__(self, function, interval, jitter, overlap):
+		if overlap not in OVERLAP_POLICIES:
+			raise ValueError("Unknown overlap policy: {}".format(overlap))
+		
+		self.function = function
+		self.interval = interval
+		self.jitter = jitter
+		self.overlap = overlap
+		self.name = getattr(function, '__name__', str(function))
+		if hasattr(function, '__self__'):
+			self.name = "{}.{}".format(type(function.__self__).__name__, self.name)
+		
+		self.last_run = None # time the last run started
+		self.last_duration = None # seconds the last finished run took
+		self.runs = 0
+		self.failures = 0
+		self.skipped = 0
+		self.running = False
+		self.pending = 0 # runs waiting for the current one to finish
+		self._next_base = None # next run time before jitter
+	
+	def _schedule_next(self, now):
+		'''Returns the next time the task should run, runs missed by more
+		than an interval aren't made up.'''
+		if self._next_base == None:
+			self._next_base = now
+		
+		self._next_base = max(self._next_base + self.interval, now)
+		return self._next_base + random.uniform(0, self.jitter)
+	
+	def stats(self):
+		'''Returns a dictionary of statistics about the task.'''
+		return {
+			"name":self.name,
+			"interval":self.interval,
+			"overlap":self.overlap,
+			"last_run":self.last_run,
+			"last_duration":self.last_duration,
+			"runs":self.runs,
+			"failures":self.failures,
+			"skipped":self.skipped,
+			"running":self.running,
+			"pending":self.pending
+		}
+
+
+class Scheduler(object):
+	''' Runs functions periodically on a fixed pool of worker threads.
+	
+	Tasks are kept in a heap ordered by their next run time, so the 
+	scheduler sleeps until exactly the next task is due. What happens when a
+	task is due while its last run is still going is decided by its overlap
+	policy.
+	'''
+	
+	def __init__(self, workers, logger):
+		self._logger = logger
+		self._pool = magpie.workers.ThreadPool(workers, "Task Worker")
+		self._condition = threading.Condition()
+		self._heap = []
+		self._tasks = []
+		self._counter = itertools.count() # breaks ties in the heap
+		self._stopped = False
+	
+	def schedule(self, function, seconds, jitter=0, overlap=OVERLAP_SKIP, delay=None):
+		'''Calls function every seconds seconds, plus a random delay of up
+		to jitter seconds. The first call is after delay seconds, or right 
+		away if it is None.
+		
+		Returns the <ScheduledTask>.
+		'''
+		task = ScheduledTask(function, seconds, jitter, overlap)
+		first = time.time() + (delay if delay != None else 0)
+		
+		with self._condition:
+			self._tasks.append(task)
+			heapq.heappush(self._heap, (first, next(self._counter), task))
+			self._condition.notify()
+		
+		return task
+	
+	def stats(self):
+		'''Returns a list of statistics for each task.'''
+		with self._condition:
+			return [task.stats() for task in self._tasks]
+	
+	def run(self):
+		'''Runs tasks as they become due until stop is called.'''
+		with self._condition:
+			while not self._stopped:
+				if len(self._heap) == 0:
+					self._condition.wait(MAX_WAIT_S)
+					continue
+				
+				due, _, task = self._heap[0]
+				now = time.time()
+				if due > now:
+					self._condition.wait(min(due - now, MAX_WAIT_S))
+					continue
+				
+				heapq.heappop(self._heap)
+				self._dispatch(task)
+				heapq.heappush(self._heap, (task._schedule_next(now), next(self._counter), task))
+	
+	def stop(self, wait=True, timeout=None):
+		'''Stops running tasks, if wait is True waits up to timeout seconds
+		(forever if None) for running tasks to finish.'''
+		with self._condition:
+			if self._stopped:
+				return
+			self._stopped = True
+			self._condition.notify_all()
+		
+		self._pool.shutdown(wait, timeout)
+	
+	def _dispatch(self, task):
+		'''Starts a run of the task, or applies its overlap policy if it's 
+		already running. Must hold _condition.'''
+		if not task.running:
+			task.running = True
+			self._pool.submit(self._run, task)
+		elif task.overlap == OVERLAP_QUEUE:
+			task.pending += 1
+		elif task.overlap == OVERLAP_COALESCE:
+			task.pending = 1
+		else:
+			task.skipped += 1
+	
+	def _run(self, task):
+		'''Runs the task, then any runs that piled up while it was going.'''
+		while True:
+			with self._condition:
+				start = time.time()
+				task.last_run = start
+			
+			failed = False
+			try:
+				task.function()
+			except Exception:
+				failed = True
+				self._logger.exception("Task {} failed".format(task.name))
+			
+			with self._condition:
+				task.last_duration = time.time() - start
+				task.runs += 1
+				task.failures += 1 if failed else 0
+				
+				if task.pending == 0 or self._stopped:
+					task.running = False
+					return
+				
+				task.pending -= 1
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+'''
+This file is part of Magpie, an automated checking framework with multiple 
+submission forms; it was originally built for automatic grading, but has many
+more potential uses than that.
+
+Copyright 2013 Joseph Lewis <joehms22@gmail.com> | <joseph@josephlewis.net>
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following disclaimer
+  in the documentation and/or other materials provided with the
+  distribution.
+* Neither the name of the  nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import json
+import re
+import threading
+from xml.sax.saxutils import escape, quoteattr
+
+
+class UnknownFormat(KeyError):
+	'''Raised when results are asked for in a format nothing writes.'''
+	pass
+
+
+_formats = {} # format name -> (writer, MIME type, file extension)
+_formats_lock = threading.Lock()
+
+# characters XML 1.0 doesn't allow even when escaped
+_XML_INVALID = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+def register(name, writer, mime_type, extension):
+	'''Registers writer(groups) as the function that writes results in the
+	named format, registering the same name again replaces it.
+	
+	groups is an iterable of (properties, results): properties is a dict 
+	describing where the results came from, e.g. the document's id and 
+	user, and results a list of <magpie.tap.TestAnythingProtocol>. The 
+	writer is a generator yielding the output a piece at a time so it can
+	be sent without holding all of it in memory.
+	'''
+	with _formats_lock:
+		_formats[name] = (writer, mime_type, extension)
+
+
+def get_format(name):
+	'''Returns (writer, MIME type, file extension) for the named format, 
+	raises UnknownFormat if there isn't one.'''
+	with _formats_lock:
+		try:
+			return _formats[name]
+		except KeyError:
+			raise UnknownFormat(name)
+
+
+def formats():
+	'''Returns the names of the registered formats.'''
+	with _formats_lock:
+		return sorted(_formats)
+
+
+def serialize(name, groups, out=None, encoding=None):
+	'''Writes groups, see register, in the named format to out, anything 
+	with a write method like a file, encoding the text first if encoding
+	is given. If out is None, returns an iterator of the pieces instead, 
+	e.g. to use as a WSGI response.
+	'''
+	chunks = get_format(name)[0](groups)
+	if encoding != None:
+		chunks = (chunk.encode(encoding) for chunk in chunks)
+	
+	if out == None:
+		return chunks
+	
+	for chunk in chunks:
+		out.write(chunk)
+
+
+def from_documents(documents):
+	'''Yields the groups, see register, for each document's results.'''
+	for document in documents:
+		yield {"document":document._document_id, "user":document.user, "frontend":document.frontend}, document.results
+
+
+def _suites(results):
+	'''The results that are TestAnythingProtocols, plugins may add others.'''
+	return [result for result in results if hasattr(result, "tests")]
+
+
+def _flatten(suite, path):
+	'''Yields (path, test) for every test in suite and its subtests, path 
+	is a list of the titles of the suites the test is in.'''
+	path = path + [suite._title or ""]
+	for test in suite.tests():
+		yield path, test
+		if test.subtest != None:
+			for item in _flatten(test.subtest, path):
+				yield item
+
+
+def json_default(value):
+	'''Converts values json can't, like dates in diagnostics, to strings,
+	pass it as json.dumps' default.'''
+	if hasattr(value, "isoformat"):
+		return value.isoformat()
+	return u"{}".format(value)
+
+
+def _dumps(value):
+	return json.dumps(value, sort_keys=True, default=json_default)
+
+
+def _xml_attr(text):
+	return quoteattr(_XML_INVALID.sub(u"", text))
+
+
+def _xml_text(text):
+	return escape(_XML_INVALID.sub(u"", text))
+
+
+def _test_dict(test, nested=True):
+	'''Returns a JSON compatible dict describing a test, if nested is 
+	False subtest is just whether it has one.'''
+	diagnostics = test.diagnostics
+	subtest = test.subtest
+	if not nested:
+		subtest = subtest != None
+	elif subtest != None:
+		subtest = _suite_dict(subtest)
+	return {
+		"number":test.number,
+		"passed":test.passed,
+		"description":test.description,
+		"todo":test.todo,
+		"skip":test.skip,
+		"diagnostics":diagnostics.data if diagnostics != None else None,
+		"subtest":subtest
+	}
+
+
+def _suite_dict(suite):
+	return {"title":suite._title, "passed":suite.passed(), "plan":suite.plan, "bail_out":suite.bail_out,
+		"tests":[_test_dict(test) for test in suite.tests()]}
+
+
+def json_writer(groups):
+	'''Writes a JSON list with an object for each group, with its 
+	properties and results, a list of suites with their tests.'''
+	yield u"["
+	for i, (properties, results) in enumerate(groups):
+		yield u"{}\n{{\"properties\": {}, \"results\": [".format("," if i > 0 else "", _dumps(properties))
+		for j, suite in enumerate(_suites(results)):
+			yield u"{}\n{{\"title\": {}, \"passed\": {}, \"plan\": {}, \"bail_out\": {}, \"tests\": [".format(
+				"," if j > 0 else "", _dumps(suite._title), _dumps(suite.passed()), _dumps(suite.plan), _dumps(suite.bail_out))
+			for k, test in enumerate(suite.tests()):
+				yield u"{}\n{}".format("," if k > 0 else "", _dumps(_test_dict(test)))
+			yield u"]}"
+		yield u"]}"
+	yield u"\n]\n"
+
+
+def ndjson_writer(groups):
+	'''Writes a JSON object on its own line for each test, including those
+	in subtests, with its group's properties and the suite it's in.'''
+	for properties, results in groups:
+		for suite in _suites(results):
+			for path, test in _flatten(suite, []):
+				line = dict(properties)
+				line.update(_test_dict(test, False))
+				line["suite"] = path
+				yield _dumps(line) + u"\n"
+
+
+def _junit_counts(suite):
+	'''Returns (tests, failures, skipped) for suite and its subtests.'''
+	tests = failures = skipped = 0
+	for path, test in _flatten(suite, []):
+		tests += 1
+		if test.skip != None or (test.todo != None and not test.passed):
+			skipped += 1
+		elif not test.passed:
+			failures += 1
+	return tests, failures, skipped
+
+
+def junit_writer(groups):
+	'''Writes JUnit XML, with a testsuite for each suite of results and a 
+	testcase for each test. Subtests' tests are included with the names of
+	the suites they're in as their classname, failing TODO tests are 
+	skipped and a suite that bailed out gets an error.'''
+	yield u'<?xml version="1.0" encoding="UTF-8"?>\n<testsuites>\n'
+	for properties, results in groups:
+		for suite in _suites(results):
+			tests, failures, skipped = _junit_counts(suite)
+			errors = 1 if suite.bail_out != None else 0
+			yield u'<testsuite name={} tests="{}" failures="{}" skipped="{}" errors="{}">\n'.format(
+				_xml_attr(suite._title or ""), tests + errors, failures, skipped, errors)
+			
+			if len(properties) > 0:
+				yield u"\t<properties>\n"
+				for key, value in sorted(properties.items()):
+					yield u"\t\t<property name={} value={}/>\n".format(_xml_attr(u"{}".format(key)), _xml_attr(u"{}".format(value)))
+				yield u"\t</properties>\n"
+			
+			for path, test in _flatten(suite, []):
+				lines = (test.description or u"").split(u"\n")
+				name = lines[0] if lines[0] != u"" else u"test {}".format(test.number)
+				case = u"\t<testcase name={} classname={}".format(_xml_attr(name), _xml_attr(u".".join(title for title in path if title)))
+				
+				if test.skip != None:
+					yield case + u"><skipped message={}/></testcase>\n".format(_xml_attr(test.skip))
+				elif test.todo != None and not test.passed:
+					yield case + u"><skipped message={}/></testcase>\n".format(_xml_attr(u"TODO " + test.todo))
+				elif not test.passed:
+					details = test.description or u""
+					if test.diagnostics != None:
+						details += u"\n" + test.diagnostics.text
+					yield case + u"><failure message={}>{}</failure></testcase>\n".format(_xml_attr(name), _xml_text(details))
+				else:
+					yield case + u"/>\n"
+			
+			if suite.bail_out != None:
+				yield u"\t<testcase name=\"Bail out!\" classname={}><error message={}/></testcase>\n".format(
+					_xml_attr(suite._title or ""), _xml_attr(suite.bail_out))
+			yield u"</testsuite>\n"
+	yield u"</testsuites>\n"
+
+
+register("junit", junit_writer, "application/xml", ".xml")
+register("json", json_writer, "application/json", ".json")
+register("ndjson", ndjson_writer, "application/x-ndjson", ".ndjson")
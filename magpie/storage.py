@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+'''
+This file is part of Magpie, an automated checking framework with multiple 
+submission forms; it was originally built for automatic grading, but has many
+more potential uses than that.
+
+Copyright 2013 Joseph Lewis <joehms22@gmail.com> | <joseph@josephlewis.net>
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following disclaimer
+  in the documentation and/or other materials provided with the
+  distribution.
+* Neither the name of the  nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+class UploadTooLarge(ValueError):
+	'''Raised when a file is bigger than the store allows.'''
+	pass
+
+
+class BadFilename(ValueError):
+	'''Raised when a file's name can't be used in a document's directory.'''
+	pass
+
+
+def iter_chunks(data):
+	'''Returns an iterator of byte strings from data, which is either bytes,
+	a file like object with a read method, or an iterable of bytes.
+	
+	Bytes and file like objects come out COPY_CHUNK_SIZE bytes at a time.
+	'''
+	if isinstance(data, bytes):
+		return (data[i:i + COPY_CHUNK_SIZE] for i in range(0, len(data), COPY_CHUNK_SIZE))
+	
+	read = getattr(data, 'read', None)
+	if read != None:
+		return iter(lambda: read(COPY_CHUNK_SIZE), b'')
+	
+	return iter(data)
+
+
+class BlobStore(object):
+	''' Stores uploaded files by the hash of their contents so identical
+	files are only kept once.
+	
+	Each unique file lives at blobs/ab/cd/abcd... under the root, and every
+	document gets a directory under documents/ with a hard link to the blob
+	for each of its files, under the name it was uploaded with. The link 
+	count of a blob doubles as its reference count. On filesystems without 
+	hard links the blob is copied instead.
+	
+	Files are copied in chunks, so only one chunk of a file is ever in 
+	memory, and files larger than max_file_size bytes are refused (0 for no
+	limit).
+	
+	A lock is held while blobs are linked in to documents or removed so a
+	release can't delete a blob store has just decided to reuse.
+	'''
+	
+	def __init__(self, root, max_file_size=0):
+		self._root = root
+		self._max_file_size = max_file_size
+		self._lock = threading.Lock()
+		self._blobs = os.path.join(root, "blobs")
+		self._documents = os.path.join(root, "documents")
+		self._tmp = os.path.join(root, "tmp")
+		
+		for directory in [self._blobs, self._documents, self._tmp]:
+			_make_directories(directory)
+	
+	def __getstate__(self):
+		'''Documents, and the store with them, are pickled to be sent to 
+		worker processes, which get a lock of their own.'''
+		state = dict(self.__dict__)
+		del state['_lock']
+		return state
+	
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = threading.Lock()
+	
+	def blob_path(self, digest):
+		'''Returns the path to the blob with the given hash.'''
+		return os.path.join(self._blobs, digest[:2], digest[2:4], digest)
+	
+	def document_directory(self, document_id):
+		'''Returns the directory holding the files for the given document.'''
+		return os.path.join(self._documents, document_id[:2], document_id)
+	
+	def store(self, document_id, name, data):
+		'''Stores data, bytes, a file like object or an iterable of bytes,
+		as the file with the given name in the document.
+		
+		Returns a tuple of (path to the document's copy, hash of the data).
+		Raises UploadTooLarge if there is more data than the store allows, 
+		or BadFilename if name is empty, "." or "..".
+		'''
+		filename = os.path.basename(name)
+		if filename in ("", ".", "..") or "\0" in filename:
+			raise BadFilename("{!r} can't be used as a file name".format(name))
+		
+		fd, tmp_path = tempfile.mkstemp(dir=self._tmp)
+		digest = hashlib.sha256()
+		size = 0
+		
+		try:
+			with os.fdopen(fd, 'wb') as tmp:
+				for chunk in iter_chunks(data):
+					size += len(chunk)
+					if self._max_file_size > 0 and size > self._max_file_size:
+						raise UploadTooLarge("{} is larger than the limit of {} bytes".format(name, self._max_file_size))
+					
+					digest.update(chunk)
+					tmp.write(chunk)
+			
+			digest = digest.hexdigest()
+			blob = self.blob_path(digest)
+			
+			parent_path = self.document_directory(document_id)
+			_make_directories(parent_path)
+			path = os.path.join(parent_path, filename)
+			
+			with self._lock:
+				if os.path.exists(blob):
+					os.remove(tmp_path)
+				else:
+					_make_directories(os.path.dirname(blob))
+					os.rename(tmp_path, blob)
+				
+				if os.path.exists(path):
+					os.remove(path)
+				
+				try:
+					os.link(blob, path)
+				except (OSError, AttributeError): # no hard links here
+					shutil.copyfile(blob, path)
+		except:
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)
+			raise
+		
+		return path, digest
+	
+	def release(self, document_id, digests):
+		'''Removes the document's files, along with any blobs in digests
+		that no other document uses any more.'''
+		shutil.rmtree(self.document_directory(document_id), ignore_errors=True)
+		
+		with self._lock:
+			for digest in digests:
+				blob = self.blob_path(digest)
+				try:
+					if os.stat(blob).st_nlink <= 1:
+						os.remove(blob)
+				except OSError:
+					pass # already gone
+
+
+def _make_directories(path):
+	'''Makes the directory and its parents if they don't already exist.'''
+	try:
+		os.makedirs(path)
+	except OSError:
+		if not os.path.isdir(path):
+			raise
@@ -1,68 +1,554 @@
-
 import re
+import json
+import array
 
-def parse_tap(source):
-	'''Parses the given text to create a new TestAnythingProtocol out of it.
+import magpie.serializers
+
+try:
+	import yaml
+except ImportError: # optional, a subset of YAML is understood without it
+	yaml = None
+
+try:
+	_STRING_TYPES = (basestring,)
+except NameError: # Python 3
+	_STRING_TYPES = (str, bytes)
+
+# these only match the start of a line, the rest is split up by _directive
+# and str methods so no line can make them backtrack for long.
+_RESULT = re.compile(r'(?P<status>not ok|ok)\b[ \t]*(?P<number>\d+)?[ \t]*(?:-(?=[ \t]|$))?', re.IGNORECASE)
+_PLAN = re.compile(r'(?P<start>\d+)\.\.(?P<end>\d+)(?=[ \t]|#|$)')
+_VERSION = re.compile(r'TAP version (?P<version>\d+)[ \t]*$', re.IGNORECASE)
+_BAIL_OUT = re.compile(r'Bail out!', re.IGNORECASE)
+_PRAGMA = re.compile(r'pragma[ \t]+(?P<sign>[+-])(?P<name>\S+)[ \t]*$')
+_SUBTEST = re.compile(r'#[ \t]*Subtest(?=:|[ \t]*$)')
+_UNESCAPE = re.compile(r'\\([\\#])')
+_DIRECTIVE = re.compile(r'[ \t]*(?P<directive>todo|skip)\S*', re.IGNORECASE)
+
+# the first character of a line -> (kind, pattern) of what it might be
+_CONSTRUCTS = {'#':("subtest", _SUBTEST), 'p':("pragma", _PRAGMA)}
+for _c in "oOnN":
+	_CONSTRUCTS[_c] = ("result", _RESULT)
+for _c in "0123456789":
+	_CONSTRUCTS[_c] = ("plan", _PLAN)
+for _c in "tT":
+	_CONSTRUCTS[_c] = ("version", _VERSION)
+for _c in "bB":
+	_CONSTRUCTS[_c] = ("bail out", _BAIL_OUT)
+
+SUBTEST_INDENT = "    "
+
+_YAML_KEY = re.compile(r'^(?P<key>"[^"]*"[ \t]*|\'[^\']*\'[ \t]*|[^:#]+):(?:\s+(?P<value>.*))?$')
+_YAML_NUMBER = re.compile(r'^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+
+
+def _yaml_scalar(text):
+	'''Decodes a YAML scalar.'''
+	text = text.strip()
+	if text in ("", "~", "null", "Null", "NULL"):
+		return None
+	if text in ("true", "True", "TRUE"):
+		return True
+	if text in ("false", "False", "FALSE"):
+		return False
+	if len(text) >= 2 and text[0] == text[-1] == '"':
+		try:
+			return json.loads(text)
+		except ValueError:
+			return text[1:-1]
+	if len(text) >= 2 and text[0] == text[-1] == "'":
+		return text[1:-1].replace("''", "'")
+	if text[0] in "[{":
+		try:
+			return json.loads(text)
+		except ValueError:
+			return text
+	if _YAML_NUMBER.match(text):
+		try:
+			return int(text)
+		except ValueError:
+			return float(text)
+	return text
+
+
+def _yaml_is_item(text):
+	return text == "-" or text.startswith("- ")
+
+
+def _yaml_block(lines, i, indent):
+	'''Decodes the mapping or list at lines[i], a list of (indent, text), 
+	returns (value, index of the line after it).'''
+	is_list = _yaml_is_item(lines[i][1])
+	result = [] if is_list else {}
+	
+	while i < len(lines) and lines[i][0] == indent:
+		text = lines[i][1]
+		if is_list:
+			if not _yaml_is_item(text):
+				break
+			
+			item = text[1:].strip()
+			if item == "":
+				value, i = _yaml_nested(lines, i + 1, indent)
+			elif _YAML_KEY.match(item): # a mapping starting on the item's line
+				lines[i] = (indent + 2, item)
+				value, i = _yaml_block(lines, i, indent + 2)
+			else:
+				value, i = _yaml_scalar(item), i + 1
+			result.append(value)
+			continue
+		
+		parsed = _YAML_KEY.match(text)
+		if parsed == None:
+			i += 1
+			continue # not something we understand
+		
+		key = _yaml_scalar(parsed.group('key'))
+		value = parsed.group('value') or ""
+		if value[:1] in ("|", ">"):
+			value, i = _yaml_text(lines, i + 1, indent, value[0] == ">")
+		elif value == "":
+			value, i = _yaml_nested(lines, i + 1, indent)
+		else:
+			value, i = _yaml_scalar(value), i + 1
+		result[key] = value
+	
+	return result, i
+
+
+def _yaml_nested(lines, i, indent):
+	'''Decodes the value of a key or list item with nothing after it.'''
+	if i < len(lines):
+		if lines[i][0] > indent or (lines[i][0] == indent and _yaml_is_item(lines[i][1])):
+			return _yaml_block(lines, i, lines[i][0])
+	return None, i
+
+
+def _yaml_text(lines, i, indent, folded):
+	'''Decodes a | or > block of text.'''
+	text = []
+	base = lines[i][0] if i < len(lines) else 0
+	while i < len(lines) and lines[i][0] > indent:
+		text.append(" " * (lines[i][0] - base) + lines[i][1])
+		i += 1
+	# like YAML, the text ends with a newline unless it ends the document
+	return (" " if folded else "\n").join(text) + ("\n" if i < len(lines) else ""), i
+
+
+def _decode_yaml(text):
+	'''Decodes YAML diagnostics with PyYAML if it is installed, otherwise
+	the subset of YAML TAP producers use: nested mappings and lists, 
+	scalars, | and > blocks and JSON.'''
+	if yaml != None:
+		return yaml.safe_load(text)
+	
+	if text.lstrip()[:1] in ("{", "["):
+		return json.loads(text)
+	
+	lines = []
+	for line in text.split("\n"):
+		stripped = line.strip()
+		if stripped == "" or stripped.startswith("#") or stripped == "---":
+			continue
+		lines.append((len(line) - len(line.lstrip(" ")), line.strip()))
+	
+	if len(lines) == 0:
+		return None
+	if len(lines) == 1 and not _YAML_KEY.match(lines[0][1]) and not _yaml_is_item(lines[0][1]):
+		return _yaml_scalar(lines[0][1])
+	return _yaml_block(lines, 0, lines[0][0])[0]
+
+
+class Diagnostics(object):
+	''' A YAML diagnostics block attached to a test, only decoded the first
+	time data is used so suites with lots of them parse quickly.
+	
+	Create one with either the YAML text or the data it holds.
+	'''
 	
-	This doesn't quite match the grammar on CPAN, but that's okay, it should
-	work for most of the varients I've seen propigated about through research
-	in the past few days.
+	def __init__(self, text=None, data=None):
+		self._text = text
+		self._data = data
+		self._decoded = text == None
 	
+	@property
+	def text(self):
+		'''The YAML text.'''
+		if self._text == None and yaml != None:
+			try:
+				self._text = yaml.safe_dump(self._data, default_flow_style=False)
+			except yaml.YAMLError:
+				pass # something only JSON's default can turn in to a string
+		if self._text == None: # JSON is YAML too
+			self._text = json.dumps(self._data, indent=2, sort_keys=True, default=magpie.serializers.json_default)
+		return self._text
+	
+	@property
+	def data(self):
+		'''The decoded diagnostics, or None if they aren't valid YAML.'''
+		if not self._decoded:
+			try:
+				self._data = _decode_yaml(self._text)
+			except Exception:
+				self._data = None
+			self._decoded = True
+		return self._data
+	
+	def __str__(self):
+		return self.text
+
+
+def _directive(text):
+	'''Splits the end of a test or plan line at its first unescaped #
+	followed by TODO or SKIP, returns (text before it, "todo" or "skip" or
+	None, reason or None).'''
+	start = text.find("#")
+	while start != -1:
+		escapes = 0
+		while start - escapes > 0 and text[start - escapes - 1] == "\\":
+			escapes += 1
+		
+		if escapes % 2 == 0:
+			parsed = _DIRECTIVE.match(text, start + 1)
+			if parsed != None:
+				return text[:start], parsed.group('directive').lower(), text[parsed.end():].strip()
+		start = text.find("#", start + 1)
+	return text, None, None
+
+
+def escape_html(text):
+	'''Returns text, or "" if it's None, escaped to put in HTML.'''
+	if text == None:
+		return u""
+	if not isinstance(text, _STRING_TYPES):
+		text = u"{}".format(text)
+	return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;").replace("'", "&#39;")
+
+
+def _lines(source):
+	'''Returns an iterator over the lines in source, a string or anything 
+	that iterates over lines.'''
+	if isinstance(source, _STRING_TYPES):
+		if isinstance(source, bytes) and not isinstance(source, str): # Python 3
+			source = source.decode("utf-8", "replace")
+		return iter(source.split("\n"))
+	return iter(source)
+
+
+def _new_test(passed, description, todo=None, skip=None, number=None, diagnostics=None, subtest=None):
+	return {"passed":passed, "description":description, "todo":todo, "skip":skip,
+		"number":number, "diagnostics":diagnostics, "subtest":subtest}
+
+
+class TapParser(object):
+	''' Parses TAP 13 and 14 a line at a time, in to tap, a 
+	TestAnythingProtocol.
+	
+	Understands version lines, plans (including skipped ones), pragmas, 
+	Bail out!, YAML diagnostics and subtests, indented four spaces with or 
+	without a "# Subtest: name" line, which become the subtest of the test 
+	line after them. Other lines starting with a space or # after a test 
+	are added to its description, everything else is ignored.
 	'''
 	
-	tap = TestAnythingProtocol()
+	def __init__(self, tap=None, keep=True):
+		'''If keep is False, top level tests are only returned by feed and
+		close, not added to tap.'''
+		self.tap = tap if tap != None else TestAnythingProtocol()
+		self._keep = keep
+		self._stack = [self.tap] # the suite and any subtests being read
+		self._titles = {} # depth -> title of the next subtest at that depth
+		self._closed = {} # depth -> subtest waiting for its test line
+		self._open = None # (depth, test) still being added to
+		self._yaml = None # (indent, lines) of the diagnostics being read
+		self._done = False # bailed out
 	
-	last_test = None
-	for line in source.split("\n"):
+	def feed(self, line):
+		'''Parses a line, returns a list of the top level tests it 
+		finished.'''
+		finished = []
+		if self._done:
+			return finished
 		
-		if len(line) <= 1:
-			continue
+		if isinstance(line, bytes) and not isinstance(line, str): # Python 3 pipes
+			line = line.decode("utf-8", "replace")
+		line = line.rstrip("\r\n")
 		
-		if re.match('^\d+\.\.\d+$', line):
-			continue # we have the plan!
+		if self._yaml != None:
+			indent, lines = self._yaml
+			if line.strip() == "...":
+				self._open[1]["diagnostics"] = Diagnostics("\n".join(lines))
+				self._yaml = None
+			else:
+				lines.append(line[indent:] if line[:indent].strip() == "" else line.lstrip())
+			return finished
 		
-		extra = re.search('^(\s|#)(?P<extratext>.+)$', line)
-		if extra != None:
-			if last_test != None:
-				last_test['description'] += "\n" + extra.groupdict()['extratext']
-			continue
+		if len(line) <= 1:
+			return finished
 		
-
-		test = {'todo':None,
-				'skip':None,
-				"description":"",
-				"passed":True} 
+		body = line.lstrip(" ")
+		indent = len(line) - len(body)
+		
+		if self._open != None and indent == self._open[0] * 4 + 2 and body.rstrip() == "---":
+			self._yaml = (indent, [])
+			return finished
 		
-		parsed = re.search('^(?P<status>not ok|ok)\s*(?P<line>\d+)?\s*(?P<description>[^#]*)(#\s*(?P<extra_type>todo|skip)\s*(?P<extra>.*))?$', line, re.IGNORECASE)
+		kind, parsed = None, None
+		if indent % 4 == 0 and body[0] in _CONSTRUCTS:
+			kind, pattern = _CONSTRUCTS[body[0]]
+			parsed = pattern.match(body)
+			if kind == "plan" and parsed != None:
+				rest = body[parsed.end():].strip()
+				if rest != "" and rest[0] != "#":
+					parsed = None # not a plan after all
 		
 		if parsed == None:
-			continue # not a good sign, improperly formattted input
-
-		parsed = parsed.groupdict()
-		test['passed'] = True if parsed['status'] == "ok" else False
-		test['description'] = parsed['description'] if parsed['description'] != None else ""
+			if self._open != None and line[0] in " \t#":
+				self._open[1]["description"] += "\n" + (body[1:] if body[0] == "#" else line[1:])
+			return finished
+		
+		depth = indent // 4
+		if self._open != None:
+			self._flush(finished)
 		
-		if parsed['extra_type'] != None:
-			parsed['extra'] = parsed['extra'] if parsed['extra'] else ""
-			if "skip" in parsed['extra_type'].lower():
-				test['skip'] = parsed['extra']
-			elif "todo" in parsed['extra_type'].lower():
-				test['todo'] = parsed['extra']
+		if kind == "result" and depth == len(self._stack) - 1 and not self._closed:
+			# the common case, another test in the suite being read
+			self._open = (depth, self._result(parsed, body, None))
+			return finished
 		
-		tap._tests.append(test)
-		last_test = test
+		if kind == "subtest":
+			name = body[parsed.end() + 1:].strip()
+			if len(self._stack) - 1 < depth: # inside the subtest it names
+				self._enter(depth, finished)
+				self._stack[-1]._title = name
+			else:
+				self._leave(depth, finished)
+				self._orphan(depth, finished)
+				self._titles[depth + 1] = name
+			return finished
+		
+		self._leave(depth, finished)
+		if kind != "result":
+			self._orphan(depth, finished)
+		self._enter(depth, finished)
+		tap = self._stack[-1]
+		
+		if kind == "result":
+			self._open = (depth, self._result(parsed, body, self._closed.pop(depth, None)))
+		elif kind == "plan":
+			tap.plan = int(parsed.group('end'))
+			ignored, directive, reason = _directive(body[parsed.end():])
+			if directive == "skip":
+				tap.plan_skip = reason
+		elif kind == "version":
+			tap.version = int(parsed.group('version'))
+		elif kind == "pragma":
+			tap.pragmas[parsed.group('name')] = parsed.group('sign') == "+"
+		elif kind == "bail out":
+			self.tap.bail_out = body[parsed.end():].strip()
+			self._leave(0, finished)
+			self._orphan(0, finished)
+			self._done = True
+		
+		return finished
+	
+	def close(self):
+		'''Finishes parsing, returns a list of the top level tests that were
+		still waiting for more lines.'''
+		finished = []
+		if self._yaml != None:
+			self._open[1]["diagnostics"] = Diagnostics("\n".join(self._yaml[1]))
+			self._yaml = None
+		self._flush(finished)
+		self._leave(0, finished)
+		self._orphan(0, finished)
+		return finished
 	
-	return tap
+	def _result(self, parsed, body, subtest):
+		description, directive, reason = _directive(body[parsed.end():])
+		description = description.strip()
+		if "\\" in description:
+			description = _UNESCAPE.sub(r'\1', description)
+		
+		status, number = parsed.group('status', 'number')
+		test = {"passed":len(status) == 2, "description":description, 
+			"todo":reason if directive == "todo" else None, 
+			"skip":reason if directive == "skip" else None,
+			"number":int(number) if number else None, "diagnostics":None, 
+			"subtest":subtest}
+		
+		if subtest != None and subtest._title == "":
+			subtest._title = description
+		return test
+	
+	def _add(self, depth, test, finished):
+		if depth > 0 or self._keep:
+			self._stack[depth]._add_test(test["passed"], test["description"], test["todo"], 
+				test["skip"], test["number"], test["diagnostics"], test["subtest"])
+		if depth == 0:
+			finished.append(test)
+	
+	def _flush(self, finished):
+		'''Adds the open test to its suite.'''
+		if self._open != None:
+			depth, test = self._open
+			self._open = None
+			self._add(depth, test, finished)
+	
+	def _orphan(self, depth, finished):
+		'''Gives a subtest that has no test line of its own one.'''
+		subtest = self._closed.pop(depth, None)
+		if subtest != None:
+			self._add(depth, _new_test(subtest.passed(), subtest._title, subtest=subtest), finished)
+	
+	def _enter(self, depth, finished):
+		'''Starts subtests until depth is reached.'''
+		while len(self._stack) - 1 < depth:
+			self._orphan(len(self._stack) - 1, finished)
+			self._stack.append(TestAnythingProtocol(self._titles.pop(len(self._stack), "")))
+	
+	def _leave(self, depth, finished):
+		'''Finishes subtests deeper than depth.'''
+		while len(self._stack) - 1 > depth:
+			self._orphan(len(self._stack) - 1, finished)
+			subtest = self._stack.pop()
+			self._closed[len(self._stack) - 1] = subtest
+
+
+def iter_tap(source, tap=None):
+	'''Parses TAP from source, a string or anything that iterates over 
+	lines like a file or a subprocess's stdout, yielding a dict for each
+	top level test with the keys passed, description, todo, skip, number, 
+	diagnostics (a Diagnostics or None) and subtest (a 
+	TestAnythingProtocol or None). See TapParser.
+	
+	Lines are read as they're needed so output of any size is parsed in 
+	constant memory. Each test is yielded once the line after it is read,
+	as lines that follow a test can belong to it. If tap is given, the 
+	tests, plan, version and so on are also added to it.
+	'''
+	parser = TapParser(tap, keep=tap != None)
+	for line in _lines(source):
+		for test in parser.feed(line):
+			yield test
+	
+	for test in parser.close():
+		yield test
+
+
+def parse_tap(source):
+	'''Parses the given text, or anything that iterates over lines, to 
+	create a new TestAnythingProtocol out of it, see TapParser.
+	'''
+	parser = TapParser()
+	for line in _lines(source):
+		parser.feed(line)
+	parser.close()
+	return parser.tap
+
+
+SKIP_TIMEOUT = "timeout" # the SKIP reason for checks a plugin ran out of time for
+
+DIRECTIVE_NONE = 0
+DIRECTIVE_TODO = 1
+DIRECTIVE_SKIP = 2
+
+
+class TestRecord(object):
+	''' A view of one test in a TestAnythingProtocol, which can also be 
+	read like a dict, e.g. test['passed'].
+	'''
+	__slots__ = ('_tap', '_index')
+	KEYS = ("passed", "description", "todo", "skip", "number", "diagnostics", "subtest")
+	
+	def __init__(self, tap, index):
+		self._tap = tap
+		self._index = index
+	
+	@property
+	def passed(self):
+		return self._tap._is_passed(self._index)
+	
+	@property
+	def description(self):
+		return self._tap._descriptions[self._index]
+	
+	@property
+	def todo(self):
+		'''The TODO reason, or None if the test isn't TODO.'''
+		return self._tap._reason(self._index, DIRECTIVE_TODO)
+	
+	@property
+	def skip(self):
+		'''The SKIP reason, or None if the test wasn't skipped.'''
+		return self._tap._reason(self._index, DIRECTIVE_SKIP)
+	
+	@property
+	def number(self):
+		return self._tap._numbers.get(self._index, self._index + 1)
+	
+	@property
+	def diagnostics(self):
+		'''The test's Diagnostics, or None.'''
+		return self._tap._extras.get(self._index, (None, None))[0]
+	
+	@property
+	def subtest(self):
+		'''The test's subtest, a TestAnythingProtocol, or None.'''
+		return self._tap._extras.get(self._index, (None, None))[1]
+	
+	def __getitem__(self, key):
+		if key not in self.KEYS:
+			raise KeyError(key)
+		return getattr(self, key)
+	
+	def get(self, key, default=None):
+		if key not in self.KEYS:
+			return default
+		return getattr(self, key)
+	
+	def to_dict(self):
+		return dict((key, getattr(self, key)) for key in self.KEYS)
 
 
 class TestAnythingProtocol:
 	''' A representation of results a suite for tests that allows them to report
 	using the TestAnythingProtocol.
 	
+	Besides its tests, a suite parsed by TapParser may have a version, a 
+	plan (the number of tests it said it would run, with plan_skip the 
+	reason if it skipped them all), the bail_out reason if it gave up and
+	the pragmas it turned on or off. Tests can have Diagnostics and a 
+	subtest, another TestAnythingProtocol.
+	
+	Suites can have tens of thousands of tests so they're stored in 
+	columns rather than an object each: a bit for whether it passed, a 
+	byte for its directive, a reference to its description, which is 
+	shared with any test that has the same one, and dict entries only for
+	the tests with a reason, an unusual number, diagnostics or a subtest. 
+	On 64 bit Pythons that's about 9 bytes per test plus 50 to 100 for 
+	each one with a dict entry and each distinct description; a suite 
+	with a quarter of its tests TODO or skipped averages about 30 bytes 
+	per test against 190 to 290 for a dict per test, see 
+	scripts/benchmark_tap.py. Read tests with tests(), which gives a 
+	TestRecord for each.
+	
 	'''
 	
-	_tests = None
 	_title = None # the title for the tests before the toHtml is called
+	_count = 0 # the number of tests
+	_passed = None # bytearray, bit i is set if test i passed
+	_directives = None # array of DIRECTIVE_* for each test
+	_descriptions = None # list of descriptions, repeats share one string
+	_reasons = None # index -> TODO or SKIP reason
+	_numbers = None # index -> number, if it isn't index + 1
+	_extras = None # index -> (diagnostics, subtest)
+	_strings = None # string -> itself, see _share
+	version = None
+	plan = None
+	plan_skip = None
+	bail_out = None
+	pragmas = None # name -> True if on, False if off
 	
 	_pass_color = "#04f200"
 	_fail_color = "#f20004"
@@ -72,8 +558,16 @@ class TestAnythingProtocol:
 		title.
 		'''
 		
-		self._tests = []
 		self._title = title
+		self.pragmas = {}
+		self._count = 0
+		self._passed = bytearray()
+		self._directives = array.array('b')
+		self._descriptions = []
+		self._reasons = {}
+		self._numbers = {}
+		self._extras = {}
+		self._strings = {}
 	
 	def pass_test(self, description, todo=None, skip=None):
 		''' Call when a test passed.
@@ -92,8 +586,22 @@ class TestAnythingProtocol:
 		a TODO or SKIP to the output with the given string afterwards.
 		'''
 		self.assert_true(False, description, todo=todo, skip=skip)
+	
+	def skip_test(self, description, reason=SKIP_TIMEOUT):
+		''' Call when a test wasn't run, by default because the plugin ran 
+		out of time, see <magpie.budget.Budget>.
+		
+		description - String, the description of the test.
+		reason - String, appended to the output after SKIP.
+		'''
+		self.assert_true(True, description, skip=reason)
+	
+	def timed_out(self):
+		'''Returns True if any test was skipped because the plugin ran out 
+		of time.'''
+		return any(reason == SKIP_TIMEOUT and self._directives[i] == DIRECTIVE_SKIP for i, reason in self._reasons.items())
 		
-	def assert_true(self, condition, description, fail_description=None, todo=None, skip=None):
+	def assert_true(self, condition, description, fail_description=None, todo=None, skip=None, diagnostics=None):
 		''' Call to report the results of something being true or not.
 		
 		condition - a boolean to tell if the test passed or failed
@@ -102,13 +610,155 @@ class TestAnythingProtocol:
 		description is used instead
 		todo|skip - mutually exclusive, a string in either of these will append
 		a TODO or SKIP to the output with the given string afterwards.
+		diagnostics - a Diagnostics, or data to make one from, to include 
+		with the test.
 		'''
 		if fail_description != None and condition == False:
 			description = fail_description
 		
-		test = {"passed":condition, "todo":todo, "skip":skip, "description":description}
-		self._tests.append(test)
+		if diagnostics != None and not isinstance(diagnostics, Diagnostics):
+			diagnostics = Diagnostics(data=diagnostics)
+		
+		self._add_test(condition, description, todo, skip, diagnostics=diagnostics)
+	
+	def add_subtest(self, subtest, description=None):
+		''' Adds subtest, another TestAnythingProtocol, as a test that passes
+		if it did, described by description or its title.'''
+		self._add_test(subtest.passed(), description if description != None else subtest._title, subtest=subtest)
+	
+	def _add_test(self, passed, description, todo=None, skip=None, number=None, diagnostics=None, subtest=None):
+		index = self._count
+		if index % 8 == 0:
+			self._passed.append(0)
+		if passed:
+			self._passed[index >> 3] |= 1 << (index & 7)
 		
+		if todo != None:
+			self._directives.append(DIRECTIVE_TODO)
+			self._reasons[index] = self._share(todo)
+		elif skip != None:
+			self._directives.append(DIRECTIVE_SKIP)
+			self._reasons[index] = self._share(skip)
+		else:
+			self._directives.append(DIRECTIVE_NONE)
+		
+		self._descriptions.append(self._strings.setdefault(description, description))
+		
+		if number != None and number != index + 1:
+			self._numbers[index] = number
+		if diagnostics != None or subtest != None:
+			self._extras[index] = (diagnostics, subtest)
+		
+		self._count += 1
+	
+	def _share(self, text):
+		'''Returns the copy of text already stored, so repeated descriptions
+		and reasons are only kept once.'''
+		return self._strings.setdefault(text, text)
+	
+	def _is_passed(self, index):
+		return bool(self._passed[index >> 3] & (1 << (index & 7)))
+	
+	def _reason(self, index, directive):
+		if self._directives[index] != directive:
+			return None
+		return self._reasons.get(index, "")
+	
+	def __len__(self):
+		return self._count
+	
+	def tests(self):
+		'''Returns an iterator of a TestRecord for each test.'''
+		return (TestRecord(self, i) for i in range(self._count))
+	
+	def __getstate__(self):
+		state = dict(self.__dict__)
+		state.pop('_strings', None) # pickle keeps shared strings shared
+		return state
+	
+	def __setstate__(self, state):
+		if '_tests' in state: # pickled before tests were stored in columns
+			tests = state.pop('_tests')
+			self.__init__(state.get('_title', ""))
+			self.__dict__.update(state)
+			for test in tests:
+				self._add_test(**test)
+			return
+		
+		self.__dict__.update(state)
+		self._strings = {}
+	
+	def passed(self):
+		'''Returns True if every test passed or is TODO, the plan was kept
+		and the suite didn't bail out.'''
+		if self.bail_out != None:
+			return False
+		if self.plan != None and self.plan != self._count:
+			return False
+		
+		for i in range(self._count):
+			if not self._is_passed(i) and self._directives[i] != DIRECTIVE_TODO:
+				return False
+		return True
+	
+	def to_tap(self, version=13):
+		'''Returns the suite as TAP, see iter_lines.'''
+		return "".join(self.iter_lines(version))
+	
+	def iter_lines(self, version=13, indent=""):
+		'''Yields the suite as lines of TAP that TapParser reads back the 
+		same way, starting with a version line unless version is None. 
+		Subtests are indented by SUBTEST_INDENT after a "# Subtest" line.'''
+		if version != None and indent == "":
+			yield "TAP version {}\n".format(version)
+		
+		for name, on in sorted(self.pragmas.items()):
+			yield "{}pragma {}{}\n".format(indent, "+" if on else "-", name)
+		
+		if self.plan_skip != None and self._count == 0:
+			yield "{}1..0 # SKIP {}\n".format(indent, self.plan_skip)
+		else:
+			yield "{}1..{}\n".format(indent, self.plan if self.plan != None else self._count)
+		
+		number = 0
+		for test in self.tests():
+			# keep parsed numbers, tests without one follow on from the last
+			number = self._numbers.get(test._index, number + 1)
+			subtest = test.subtest
+			if subtest != None:
+				yield u"{}# Subtest: {}\n".format(indent, subtest._title)
+				for line in subtest.iter_lines(None, indent + SUBTEST_INDENT):
+					yield line
+			
+			lines = (test.description or "").split("\n")
+			line = u"{}{} {}".format(indent, "ok" if test.passed else "not ok", number)
+			if lines[0] != "":
+				line += u" - " + lines[0].replace("\\", "\\\\").replace("#", "\\#")
+			if test.todo != None:
+				line += u" # TODO " + test.todo
+			elif test.skip != None:
+				line += u" # SKIP " + test.skip
+			yield line.rstrip() + "\n"
+			
+			diagnostics = test.diagnostics
+			if diagnostics != None:
+				yield "{}  ---\n".format(indent)
+				for yaml_line in diagnostics.text.rstrip("\n").split("\n"):
+					yield u"{}  {}\n".format(indent, yaml_line)
+				yield "{}  ...\n".format(indent)
+			
+			for extra in lines[1:]:
+				yield u"{}#{}\n".format(indent, extra)
+		
+		if self.bail_out != None and indent == "":
+			yield u"Bail out! {}\n".format(self.bail_out)
+		
+	def serialize(self, format_name, out=None, encoding=None):
+		'''Writes the suite in one of the formats registered in 
+		<magpie.serializers>, e.g. "junit", to out, or returns an iterator 
+		of the pieces if out is None. See magpie.serializers.serialize.'''
+		return magpie.serializers.serialize(format_name, [({}, [self])], out, encoding)
+	
 	def to_html(self, pass_i18n="Pass", fail_i18n="Fail", status_i18n="Status", description_i18n="Description", extra_i18n="Extra"):
 		'''Converts this instance of the TAP to an HTML table.
 		
@@ -121,42 +771,52 @@ class TestAnythingProtocol:
 		extra_i18n -- i18n for "Extra"
 		
 		'''
-		
-		output = """
+		return u"".join(self.iter_html(pass_i18n, fail_i18n, status_i18n, description_i18n, extra_i18n))
+	
+	def iter_html(self, pass_i18n="Pass", fail_i18n="Fail", status_i18n="Status", description_i18n="Description", extra_i18n="Extra"):
+		'''Yields the HTML table to_html returns a row at a time so big 
+		suites can be sent as they're rendered. The title, descriptions and
+		reasons are escaped, subtests are tables inside their test's row.
+		'''
+		yield u"""
 <table>
 	<tr><th colspan='3'>{title}</th></tr>
 	<tr><th>{status}</th><th>{desc}</th><th>{extra}</th></tr>
-""".format(title=self._title, status=status_i18n, desc=description_i18n,extra=extra_i18n )
+""".format(title=escape_html(self._title), status=status_i18n, desc=description_i18n, extra=extra_i18n)
 		
-		for test in self._tests:
-			color = self._pass_color if test['passed'] else self._fail_color
-			status = pass_i18n if test['passed'] else fail_i18n
-
-			extra_info = test['todo'] if test['todo'] else ""
-			extra_info = test['skip'] if test['skip'] else extra_info
+		for test in self.tests():
+			color = self._pass_color if test.passed else self._fail_color
+			status = pass_i18n if test.passed else fail_i18n
 			
-			output += """
+			extra_info = test.todo if test.todo else ""
+			extra_info = test.skip if test.skip else extra_info
+			
+			yield u"""
 	<tr>
 		<td style="background-color:{};">{}</td>
+		<td>{}""".format(color, status, escape_html(test.description).replace("\n", "<br/>"))
+			
+			if test.subtest != None:
+				for html in test.subtest.iter_html(pass_i18n, fail_i18n, status_i18n, description_i18n, extra_i18n):
+					yield html
+			
+			yield u"""</td>
 		<td>{}</td>
-		<td>{}</td>
-	</tr>""".format(color, status, test['description'].replace("\n", "<br/>"), extra_info)
+	</tr>""".format(escape_html(extra_info))
 		
-		output += "\n</table>"
-		
-		return output
+		yield u"\n</table>"
 	
 	def __str__(self):
 		'''Returns a tap style output for the given interface.'''
-		if len(self._tests) == 0:
+		if self._count == 0:
 			return ""
 		
-		output = "1..{}\n".format(len(self._tests))
+		output = "1..{}\n".format(self._count)
 		
 		if self._title != "":
 			output += "#{}\n".format(self._title)
 		
-		for i, test in enumerate(self._tests):
+		for i, test in enumerate(self.tests()):
 			status = "ok" if test['passed'] else "not ok"
 			status += " {} ".format(i + 1)
 			
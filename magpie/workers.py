@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+
+'''
+This file is part of Magpie, an automated checking framework with multiple 
+submission forms; it was originally built for automatic grading, but has many
+more potential uses than that.
+
+Copyright 2013 Joseph Lewis <joehms22@gmail.com> | <joseph@josephlewis.net>
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following disclaimer
+  in the documentation and/or other materials provided with the
+  distribution.
+* Neither the name of the  nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import threading
+import multiprocessing
+import importlib
+import logging
+import os
+import signal
+import sys
+import time
+
+try:
+	import resource
+except ImportError: # not available on Windows
+	resource = None
+
+try:
+	import queue
+except ImportError: # Python 2
+	import Queue as queue
+
+from magpie.plugins.abstract_plugin import AbstractPlugin
+import magpie.budget
+
+PARENT_CHECK_S = 1 # how often idle workers check the core is still running
+CANCEL_CHECK_S = 0.25 # how often supervisors check if the core gave up on a job
+SHUTDOWN_CHECK_S = 0.25 # how often idle threads check if their pool was shut down
+
+
+class WorkerTimeout(Exception):
+	'''Raised when a result is not ready before its timeout.'''
+	pass
+
+
+class WorkerCrashed(Exception):
+	'''Raised when the process running a job dies before it finishes.'''
+	pass
+
+
+class PendingResult(object):
+	'''The result of a function that was handed to a pool, it will be filled
+	in once a worker gets around to running it.
+	'''
+	
+	started_at = None # when a worker picked it up
+	
+	def __init__(self):
+		self._event = threading.Event()
+		self._started = threading.Event()
+		self._result = None
+		self._exception = None
+	
+	def mark_started(self, now=None):
+		'''Called by the pool when a worker starts on it.'''
+		self.started_at = now if now != None else time.time()
+		self._started.set()
+	
+	def wait_started(self, timeout=None):
+		'''Waits up to timeout seconds (forever if None) for a worker to 
+		start on it or for the result, returns True if either happened.'''
+		return self._started.wait(timeout)
+	
+	def set_result(self, result):
+		self._result = result
+		self._event.set()
+		self._started.set()
+	
+	def set_exception(self, exception):
+		self._exception = exception
+		self._event.set()
+		self._started.set()
+
+	def cancel(self):
+		'''Gives up on the result, if it hasn't been started yet it won't 
+		be.'''
+		if not self.done():
+			self.set_exception(WorkerTimeout("Cancelled"))
+
+	def done(self):
+		'''Returns True if the result is available.'''
+		return self._event.is_set()
+	
+	def result(self, timeout=None):
+		'''Waits up to timeout seconds (forever if None) for the result and
+		returns it, re-raises the exception if the function raised one.
+		
+		Raises WorkerTimeout if the result doesn't show up in time.
+		'''
+		if not self._event.wait(timeout):
+			raise WorkerTimeout("Result not ready after {} seconds".format(timeout))
+		
+		if self._exception != None:
+			raise self._exception
+		
+		return self._result
+
+
+class ThreadPool(object):
+	'''A fixed size pool of daemon threads that run functions handed to them
+	through submit().
+	
+	If max_pending is more than 0, submit blocks while that many functions
+	are already waiting to be run.
+	'''
+	
+	def __init__(self, workers, name="Worker", max_pending=0):
+		self._queue = queue.Queue(max_pending)
+		self._threads = []
+		self._closed = False # once set, threads stop when the queue is empty
+		
+		for i in range(max(1, workers)):
+			thread = threading.Thread(target=self._work, name="{} {}".format(name, i))
+			thread.daemon = True
+			thread.start()
+			self._threads.append(thread)
+	
+	def _work(self):
+		while True:
+			try:
+				item = self._queue.get(True, SHUTDOWN_CHECK_S if self._closed else None)
+			except queue.Empty:
+				return # shut down and everything submitted is done
+			
+			if item == None: # told to shut down
+				return
+			
+			pending, function, args, kwargs = item
+			if pending.done(): # cancelled before we got to it
+				continue
+			
+			pending.mark_started()
+			try:
+				pending.set_result(function(*args, **kwargs))
+			except Exception as e:
+				pending.set_exception(e)
+	
+	def submit(self, function, *args, **kwargs):
+		'''Runs function(*args, **kwargs) on one of the threads in the pool,
+		returns a PendingResult.
+		'''
+		pending = PendingResult()
+		self._queue.put((pending, function, args, kwargs))
+		return pending
+	
+	def shutdown(self, wait=True, timeout=None):
+		'''Stops the threads once they have finished the work already 
+		submitted, if wait is True waits up to timeout seconds (forever if 
+		None) for them.'''
+		self._closed = True
+		deadline = None if timeout == None else time.time() + timeout
+		for thread in self._threads:
+			try:
+				if not wait:
+					self._queue.put_nowait(None)
+				else:
+					self._queue.put(None, True, None if deadline == None else max(0, deadline - time.time()))
+			except queue.Full:
+				break # the threads stop once they've emptied the queue instead
+		
+		if wait:
+			_join_all(self._threads, None if deadline == None else max(0, deadline - time.time()))
+
+
+class SerialPool(object):
+	'''Has the same interface as ThreadPool, but runs everything in the 
+	caller's thread. Timeouts can't be enforced.'''
+	
+	def submit(self, function, *args, **kwargs):
+		pending = PendingResult()
+		pending.mark_started()
+		try:
+			pending.set_result(function(*args, **kwargs))
+		except Exception as e:
+			pending.set_exception(e)
+		return pending
+	
+	def shutdown(self, wait=True, timeout=None):
+		pass
+
+
+def _join_all(threads, timeout):
+	'''Joins the threads, giving up once timeout seconds (None for never)
+	have passed.'''
+	deadline = None if timeout == None else time.time() + timeout
+	for thread in threads:
+		thread.join(None if deadline == None else max(0, deadline - time.time()))
+
+
+def _plugin_key(plugin):
+	'''Returns the key used to find a plugin in a worker process.'''
+	return tuple(plugin.get_class_key())
+
+
+def _peak_memory_mb():
+	'''Returns the most memory this process has used in MB, or 0 if it
+	can't be found on this platform.'''
+	if resource == None:
+		return 0
+	
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == "darwin": # bytes rather than KB
+		peak = peak / 1024
+	return peak / 1024
+
+
+def _worker_main(connection, plugin_specs, max_jobs, max_memory_mb):
+	'''The loop run by each grading worker process.
+	
+	Each plugin is created the first time the process is given a job for 
+	it and kept for later jobs, then jobs are read from the connection until
+	the core says to stop or the process has done max_jobs jobs or used more
+	than max_memory_mb MB, at which point the worker asks to be replaced and
+	exits.
+	
+	Each job's reply is a tuple of (succeeded, result or exception, recycle).
+	'''
+	# the core decides when workers stop, don't die mid-job on Ctrl-C.
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+	configs = dict(((module_name, class_name), config) for module_name, class_name, config in plugin_specs)
+	plugins = {}
+	
+	def get_plugin(key):
+		if key not in plugins:
+			module_name, class_name = key
+			plugin = getattr(importlib.import_module(module_name), class_name)()
+			plugin._logger = logging.getLogger(plugin.get_name())
+			# skip any overridden update_config, frontends start servers there.
+			AbstractPlugin.update_config(plugin, configs.get(key, None) or {})
+			plugins[key] = plugin
+		return plugins[key]
+	
+	parent = os.getppid()
+	jobs = 0
+	while True:
+		try:
+			# exit if the core dies, other workers may hold the pipe open
+			while not connection.poll(PARENT_CHECK_S):
+				if os.getppid() != parent:
+					return
+			message = connection.recv()
+		except EOFError:
+			return
+		
+		if message == None: # told to shut down
+			return
+		
+		key, method, args, budget = message
+		try:
+			outcome = (True, magpie.budget.call(getattr(get_plugin(key), method), args, budget))
+		except Exception as e:
+			outcome = (False, e)
+		
+		jobs += 1
+		recycle = (max_jobs > 0 and jobs >= max_jobs) or (max_memory_mb > 0 and _peak_memory_mb() >= max_memory_mb)
+		
+		try:
+			connection.send(outcome + (recycle,))
+		except Exception as e: # results or exception that can't be pickled
+			connection.send((False, WorkerCrashed("Couldn't send result: {}".format(e)), recycle))
+		
+		if recycle:
+			return
+
+
+class ProcessPool(object):
+	'''A pool of worker processes that run plugins' process_upload and 
+	process_batch so a plugin that crashes, hangs or eats all the memory 
+	takes down a worker rather than the core.
+	
+	Each worker loads a plugin once, on its first job, and is replaced after
+	max_jobs jobs, after using max_memory_mb MB, if it crashes or if a job
+	runs longer than its timeout. A value of 0 disables the job or memory
+	limit.
+	'''
+	
+	def __init__(self, workers, get_plugins, max_jobs=0, max_memory_mb=0, logger=None):
+		'''get_plugins() returns the list of plugins new workers should load,
+		it is called each time a worker is started so they pick up new 
+		configurations.'''
+		self._get_plugins = get_plugins
+		self._max_jobs = max_jobs
+		self._max_memory_mb = max_memory_mb
+		self._logger = logger if logger != None else logging.getLogger("Process Pool")
+		self._queue = queue.Queue()
+		self._threads = []
+		
+		for i in range(max(1, workers)):
+			thread = threading.Thread(target=self._supervise, name="Process Supervisor {}".format(i))
+			thread.daemon = True
+			thread.start()
+			self._threads.append(thread)
+	
+	def _spawn(self):
+		'''Starts a new worker process, returns (process, connection).'''
+		specs = [_plugin_key(p) + (p.get_config(),) for p in self._get_plugins()]
+		
+		parent_connection, child_connection = multiprocessing.Pipe()
+		process = multiprocessing.Process(target=_worker_main, 
+			args=(child_connection, specs, self._max_jobs, self._max_memory_mb))
+		process.daemon = True
+		process.start()
+		child_connection.close()
+		return process, parent_connection
+	
+	def _kill(self, process, connection):
+		connection.close()
+		if process.is_alive():
+			process.terminate()
+		process.join()
+	
+	def _wait(self, connection, pending, deadline):
+		'''Waits for the worker's reply, returns False if the deadline (None
+		for never) passes or the core cancels the job first.'''
+		while True:
+			wait = CANCEL_CHECK_S
+			if deadline != None:
+				wait = min(wait, deadline - time.time())
+			if connection.poll(max(0, wait)):
+				return True
+			if pending.done() or (deadline != None and time.time() >= deadline):
+				return False
+	
+	def _supervise(self):
+		'''Feeds jobs to one worker process, replacing it as needed.'''
+		process, connection = self._spawn()
+		
+		while True:
+			item = self._queue.get()
+			if item == None: # told to shut down
+				try:
+					connection.send(None)
+				except (IOError, EOFError):
+					pass
+				process.join()
+				return
+			
+			pending, message, timeout = item
+			if pending.done(): # the core gave up waiting before we started
+				continue
+			
+			# the budget and the timeout both start now, as the core's wait does
+			now = time.time()
+			budget = message[3]
+			if budget != None:
+				budget.start(now)
+			pending.mark_started(now)
+			deadline = None if timeout == None else now + timeout
+			
+			try:
+				connection.send(message)
+				
+				if not self._wait(connection, pending, deadline):
+					cancelled = pending.done()
+					self._logger.error("Worker {} {}, restarting it".format(process.pid, "was cancelled" if cancelled else "timed out"))
+					self._kill(process, connection)
+					process, connection = self._spawn()
+					if not cancelled:
+						pending.set_exception(WorkerTimeout("Worker timed out after {} seconds".format(timeout)))
+					continue
+				
+				succeeded, value, recycle = connection.recv()
+			except (IOError, EOFError):
+				self._kill(process, connection)
+				self._logger.error("Worker {} crashed with exit code {}, restarting it".format(process.pid, process.exitcode))
+				pending.set_exception(WorkerCrashed("Worker crashed with exit code {}".format(process.exitcode)))
+				process, connection = self._spawn()
+				continue
+			except Exception as e: # document couldn't be pickled
+				pending.set_exception(e)
+				continue
+			
+			if succeeded:
+				pending.set_result(value)
+			else:
+				pending.set_exception(value)
+			
+			if recycle:
+				self._logger.info("Recycling worker {}".format(process.pid))
+				process.join()
+				process, connection = self._spawn()
+	
+	def submit_upload(self, plugin, document, test_configuration, timeout=None, budget=None):
+		'''Runs plugin.process_upload(document, test_configuration) in one
+		of the worker processes, returns a PendingResult.
+		
+		The worker is killed if it runs for longer than timeout seconds from
+		when it starts on the job, or if the result is cancelled. budget, a 
+		<magpie.budget.Budget>, is started then and passed on if the plugin 
+		takes one.
+		'''
+		return self._submit(plugin, "process_upload", (document, test_configuration), timeout, budget)
+	
+	def submit_batch(self, plugin, documents, test_configuration, timeout=None, budget=None):
+		'''Runs plugin.process_batch(documents, test_configuration) in one of
+		the worker processes, returns a PendingResult.
+		
+		The worker is killed if it runs for longer than timeout seconds from
+		when it starts on the job, or if the result is cancelled. budget, a 
+		<magpie.budget.Budget>, is started then and passed on if the plugin 
+		takes one.
+		'''
+		return self._submit(plugin, "process_batch", (documents, test_configuration), timeout, budget)
+	
+	def _submit(self, plugin, method, args, timeout, budget=None):
+		pending = PendingResult()
+		self._queue.put((pending, (_plugin_key(plugin), method, args, budget), timeout))
+		return pending
+	
+	def shutdown(self, wait=True, timeout=None):
+		'''Stops the workers once they have finished the work already
+		submitted, if wait is True waits up to timeout seconds (forever if 
+		None) for them.'''
+		for thread in self._threads:
+			self._queue.put(None)
+		
+		if wait:
+			_join_all(self._threads, timeout)
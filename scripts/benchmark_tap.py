@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+'''
+This file is part of Magpie, an automated checking framework with multiple 
+submission forms; it was originally built for automatic grading, but has many
+more potential uses than that.
+
+Copyright 2013 Joseph Lewis <joehms22@gmail.com> | <joseph@josephlewis.net>
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above
+  copyright notice, this list of conditions and the following disclaimer
+  in the documentation and/or other materials provided with the
+  distribution.
+* Neither the name of the  nor the names of its
+  contributors may be used to endorse or promote products derived from
+  this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+"AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Measures the memory and time TestAnythingProtocol takes for large suites,
+against the dict per test it used to store, e.g.
+
+	python scripts/benchmark_tap.py 50000
+'''
+
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import magpie.tap
+
+try:
+	import tracemalloc
+except ImportError: # Python 2
+	tracemalloc = None
+
+DESCRIPTIONS = ["Minimum Blocks", "Minimum Sprites", "Minimum Scripts", "Minimum Sounds"]
+
+
+def make_suite(count):
+	tap = magpie.tap.TestAnythingProtocol("Benchmark")
+	for i in range(count):
+		if i % 10 == 0:
+			tap.fail(DESCRIPTIONS[i % len(DESCRIPTIONS)], todo="later")
+		elif i % 7 == 0:
+			tap.skip_test(DESCRIPTIONS[i % len(DESCRIPTIONS)])
+		else:
+			tap.pass_test(DESCRIPTIONS[i % len(DESCRIPTIONS)])
+	return tap
+
+
+def make_dicts(count):
+	'''The storage TestAnythingProtocol used before it had columns.'''
+	tests = []
+	for i in range(count):
+		todo = "later" if i % 10 == 0 else None
+		skip = magpie.tap.SKIP_TIMEOUT if i % 10 != 0 and i % 7 == 0 else None
+		tests.append({"passed":i % 10 != 0, "todo":todo, "skip":skip, "description":DESCRIPTIONS[i % len(DESCRIPTIONS)]})
+	return tests
+
+
+def _deep_size(value, seen):
+	if id(value) in seen:
+		return 0
+	seen.add(id(value))
+	size = sys.getsizeof(value)
+	if isinstance(value, dict):
+		size += sum(_deep_size(k, seen) + _deep_size(v, seen) for k, v in value.items())
+	elif isinstance(value, (list, tuple)):
+		size += sum(_deep_size(v, seen) for v in value)
+	elif hasattr(value, "__dict__"):
+		size += _deep_size(value.__dict__, seen)
+	return size
+
+
+def measure(function, count):
+	'''Returns (bytes, seconds) to build function(count).'''
+	gc.collect()
+	if tracemalloc != None:
+		tracemalloc.start()
+		start = time.time()
+		value = function(count)
+		seconds = time.time() - start
+		size = tracemalloc.get_traced_memory()[0]
+		tracemalloc.stop()
+	else:
+		start = time.time()
+		value = function(count)
+		seconds = time.time() - start
+		size = _deep_size(value, set())
+	return size, seconds
+
+
+def main(count):
+	print("{} tests, memory measured with {}".format(count, "tracemalloc" if tracemalloc != None else "sys.getsizeof"))
+	for name, function in [("columns", make_suite), ("dict per test", make_dicts)]:
+		size, seconds = measure(function, count)
+		print("{:>15}: {:>12,} bytes, {:6.1f} bytes/test, built in {:.3f}s".format(name, size, float(size) / count, seconds))
+	
+	suite = make_suite(count)
+	start = time.time()
+	text = suite.to_tap()
+	emitted = time.time() - start
+	
+	start = time.time()
+	parsed = magpie.tap.parse_tap(text)
+	seconds = time.time() - start
+	print("{:>15}: {:.3f}s to emit, {:.3f}s to parse {:,} bytes of TAP".format("TAP", emitted, seconds, len(text)))
+	assert len(parsed) == count
+
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)